@@ -1,20 +1,125 @@
+import asyncio
 from asyncio.log import logger
 from datetime import datetime
-from typing import List, Optional
+from typing import Awaitable, Callable, List, Optional
 from aiogram import Bot
-from sqlalchemy import func, or_, select, update, delete
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
-from zoneinfo import ZoneInfo
-import json
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+from sqlalchemy import Row, func, insert, lambda_stmt, or_, select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import raiseload, selectinload
+import orjson
 from sqlalchemy import text, update
-from datetime import datetime
-from zoneinfo import ZoneInfo
 import logging
 
-from app.database.state import LeadMagnetState
-from app.database.models import FeedbackOptions, LeadSource, StageText, User, MessageSchedule, Broadcast
-
+from app.database.models import (
+    DEBUG, FeedbackOptions, LeadMagnetStat, LeadSource, StageText, User, MessageSchedule, Broadcast
+)
+from app.database.crud_user import get_user_count, user_count_cache
+from app.utils.cache import TTLCache, cached
+from app.utils.paginator import paginate_query
+from app.utils.rate_limit import TokenBucket
+
+# Сколько отправок в Telegram держим «в полёте» одновременно: ~30 msg/s лимит Bot API,
+# оставляем запас под ответы хендлеров, идущие параллельно с рассылкой
+BROADCAST_CONCURRENCY = 25
+
+# Общий темп массовых отправок (рассылки и запланированные сообщения): 30 msg/s Bot API
+telegram_bucket = TokenBucket(rate=30, capacity=30)
+
+# Опции загрузки для списков пользователей: lead_source подгружаем сразу
+# одним IN-запросом на страницу, а в DEBUG любая другая ленивая загрузка (N+1)
+# падает с ошибкой. Источник грузится целиком: частично загруженный объект
+# в сессии дочитывал бы остальные колонки лениво, а под asyncio это MissingGreenlet
+_LEAD_SOURCE = selectinload(User.lead_source)
+USER_LIST_OPTIONS = (
+    (_LEAD_SOURCE, raiseload("*"))
+    if DEBUG else
+    (_LEAD_SOURCE,)
+)
+
+# Ручные рассылки из админки идут по одной; ссылки на фоновые задачи держим,
+# чтобы сборщик мусора не снял их до завершения
+_broadcast_slot = asyncio.Semaphore(1)
+_background_tasks: set[asyncio.Task] = set()
+
+# Единые часы планировщика: «сейчас» берёт БД (время хранится naive по Алматы),
+# чтобы выборка наступивших задач и расчёт паузы до следующей не расходились
+# при рассинхроне часов приложения и базы
+ALMATY_NOW_SQL = "(now() AT TIME ZONE 'Asia/Almaty')"
+
+# SQL планировщика собран один раз: текст запроса не меняется от тика к тику,
+# поэтому ключ кэша компиляции SQLAlchemy и подготовленный запрос asyncpg
+# переиспользуются, а не пересоздаются на каждом вызове
+PENDING_MSGS_SQL = text(f"""
+    SELECT ms.id, ms.message_text, u.user_id as tg_id
+    FROM message_schedule ms
+    JOIN "user" u ON u.id = ms.user_id
+    WHERE ms.send_time <= {ALMATY_NOW_SQL}
+      AND ms.sent = false
+    FOR UPDATE OF ms SKIP LOCKED
+""")
+
+# Захват рассылок: статус 'sending' коммитится до отправки — повторно их уже не выберут
+CLAIM_BROADCASTS_SQL = text(f"""
+    UPDATE broadcast
+    SET status = 'sending'
+    WHERE id IN (
+        SELECT id FROM broadcast
+        WHERE scheduled_at <= {ALMATY_NOW_SQL}
+          AND (status IS NULL OR status = 'pending')
+          AND is_sent = false
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, title, content, file_id, file_type, scheduled_at
+""")
+
+# Захват одной рассылки из админки — тем же статусом 'sending', атомарно
+CLAIM_BROADCAST_SQL = text("""
+    UPDATE broadcast
+    SET status = 'sending'
+    WHERE id = :id
+      AND is_sent = false
+      AND (status IS NULL OR status = 'pending')
+    RETURNING file_type, file_id, content, target_lead_id
+""")
+
+MARK_BROADCAST_SENT_SQL = text(f"""
+    UPDATE broadcast
+    SET is_sent = true,
+        status = 'sent',
+        sent_count = :total,
+        updated = {ALMATY_NOW_SQL}
+    WHERE id = :id
+""")
+
+# Один параметр-массив вместо IN (...) — текст запроса не зависит от размера пачки
+MARK_MSGS_SENT_SQL = text("UPDATE message_schedule SET sent = true WHERE id = ANY(:ids)")
+
+# Сколько секунд до ближайшей задачи планировщика (оба min — по частичным индексам).
+# Считается по тем же часам БД (ALMATY_NOW_SQL), что и выборка задач; NULL — очередь пуста
+NEXT_DUE_DELAY_SQL = text(f"""
+    SELECT EXTRACT(EPOCH FROM LEAST(
+        (SELECT min(send_time) FROM message_schedule WHERE sent = false),
+        (SELECT min(scheduled_at) FROM broadcast
+         WHERE is_sent = false AND (status IS NULL OR status = 'pending'))
+    ) - {ALMATY_NOW_SQL})::float8
+""")
+
+# Канал LISTEN/NOTIFY: новая запланированная задача будит планировщик раньше срока.
+# NOTIFY внутри транзакции доставляется только после коммита
+SCHEDULE_CHANNEL = "schedule_new"
+NOTIFY_SCHEDULE_SQL = text(f"NOTIFY {SCHEDULE_CHANNEL}")
+
+# Источники лидов меняются только из админки — держим их в памяти процесса
+lead_source_cache = TTLCache(ttl=3600)
+
+# Общее число строк для пагинации в админке: листание страниц не пересчитывает COUNT(*)
+paginate_meta_cache = TTLCache(ttl=60)
+
+# Тексты этапов и варианты отзыва читаются на каждое действие пользователя,
+# а меняются только из админки (там кэш сбрасывается сразу). TTL короткий,
+# чтобы правки напрямую в БД или из другого процесса доезжали за 5 минут
+stage_cache = TTLCache(ttl=300)
 
 # ==========================================================
 # 1. LEAD SOURCE — управление источниками лидов (воронками)
@@ -27,27 +132,63 @@ async def create_empty_lead_source(session: AsyncSession, name: str) -> LeadSour
     lead = LeadSource(name=name)
     session.add(lead)
     await session.commit()
-    await session.refresh(lead)
+    lead_source_cache.clear()
+    paginate_meta_cache.invalidate("lead_sources")
     return lead
 
 
-async def update_lead_description(session: AsyncSession, lead_id: int, description: str) -> LeadSource:
+async def update_lead_description(session: AsyncSession, lead_id: int, description: str) -> Row:
     """
     Обновляет описание источника лида (второй шаг FSM).
+    Возвращает (name, description) прямо из UPDATE ... RETURNING — без повторного SELECT.
     """
-    query = update(LeadSource).where(LeadSource.id == lead_id).values(description=description)
-    await session.execute(query)
+    query = (
+        update(LeadSource)
+        .where(LeadSource.id == lead_id)
+        .values(description=description)
+        .returning(LeadSource.name, LeadSource.description)
+    )
+    lead = (await session.execute(query)).one()
     await session.commit()
-    result = await session.execute(select(LeadSource).where(LeadSource.id == lead_id))
-    return result.scalar_one()
+    lead_source_cache.clear()
+    paginate_meta_cache.invalidate("lead_sources")
+    return lead
 
 
 async def get_lead_sources(session: AsyncSession) -> list[LeadSource]:
     """
-    Возвращает список всех источников лидов.
+    Возвращает список всех источников лидов (с кэшем в памяти).
+    Объекты отвязаны от сессии — читаем только простые поля, без связей.
     """
-    result = await session.execute(select(LeadSource))
-    return result.scalars().all()
+    async def _fetch() -> list[LeadSource]:
+        result = await session.execute(select(LeadSource))
+        leads = result.scalars().all()
+        for lead in leads:
+            session.expunge(lead)
+        return leads
+
+    return await cached(lead_source_cache, "all", _fetch)
+
+
+async def get_lead_sources_with_counts(
+    session: AsyncSession, page: int = 1, per_page: int = 5
+) -> tuple[list[tuple[LeadSource, int]], int]:
+    """
+    Страница источников лидов вместе с числом пользователей в каждом и общее число источников.
+    Считает база одним GROUP BY — пользователи в память не загружаются.
+    """
+    stmt = (
+        select(LeadSource, func.count(User.id).label("users_count"))
+        .outerjoin(User, User.lead_source_id == LeadSource.id)
+        .group_by(LeadSource.id)
+        .order_by(LeadSource.id)
+    )
+    # Число источников = число групп; считаем без JOIN по пользователям и кэшируем
+    async def _count() -> int:
+        return await session.scalar(select(func.count(LeadSource.id)))
+
+    total = await cached(paginate_meta_cache, "lead_sources", _count)
+    return await paginate_query(session, stmt, page, per_page, total=total)
 
 
 async def delete_lead_source(session: AsyncSession, lead_id: int) -> None:
@@ -56,6 +197,8 @@ async def delete_lead_source(session: AsyncSession, lead_id: int) -> None:
     """
     await session.execute(delete(LeadSource).where(LeadSource.id == lead_id))
     await session.commit()
+    lead_source_cache.clear()
+    paginate_meta_cache.invalidate("lead_sources")
 
 
 async def add_lead_magnet_stat(
@@ -67,7 +210,7 @@ async def add_lead_magnet_stat(
     feedback_type: Optional[str] = None
 ):
     """Добавление статистики лид-магнита."""
-    stat = LeadMagnetState(
+    stat = LeadMagnetStat(
         user_id=user_id,
         template_version=template_version,
         stage=stage,
@@ -75,6 +218,15 @@ async def add_lead_magnet_stat(
         feedback_type=feedback_type
     )
     session.add(stat)
+
+
+async def add_lead_magnet_stats_bulk(session: AsyncSession, rows: list[dict]) -> None:
+    """Пачка записей статистики лид-магнита одним INSERT (executemany) и одним коммитом."""
+    if not rows:
+        return
+    await session.execute(insert(LeadMagnetStat), rows)
+    await session.commit()
+
 # ==========================================================
 # 2. USER — управление пользователями Telegram
 # ==========================================================
@@ -84,38 +236,45 @@ async def get_all_users(session: AsyncSession) -> list[User]:
     Возвращает всех пользователей с их источниками.
     """
     result = await session.execute(
-        select(User).options(joinedload(User.lead_source))
+        select(User).options(*USER_LIST_OPTIONS)
     )
-    return result.scalars().unique().all()
+    return result.scalars().all()
 
 
-async def get_users_by_lead_source(session: AsyncSession, lead_source_id: int) -> list[User]:
+async def get_users_by_lead_source(session: AsyncSession, lead_source_id: int) -> list[Row]:
     """
-    Возвращает всех пользователей, принадлежащих указанной воронке (по имени).
+    Возвращает пользователей воронки lead_source_id — только колонки для вывода списка.
+    Строки Row не привязаны к сессии, поэтому результат можно отдать другим хендлерам.
     """
     query = (
-        select(User)
-        .join(LeadSource)
-        .where(LeadSource.id == lead_source_id)
-        .options(joinedload(User.lead_source))
+        select(
+            User.user_id, User.username, User.first_name,
+            User.last_name, User.phone, User.registered_at,
+        )
+        .where(User.lead_source_id == lead_source_id)
     )
     result = await session.execute(query)
-    return result.scalars().all()
+    return result.all()
 
 
-async def assign_user_to_lead_source(session: AsyncSession, user_tg_id: int, lead_source_name: str) -> None:
+async def _fetch_recipient_tg_ids(session: AsyncSession, lead_source_id: Optional[int] = None) -> list[int]:
     """
-    Привязывает пользователя к воронке по её имени.
+    Telegram ID получателей рассылки — всех пользователей или только воронки lead_source_id.
+    Читает напрямую через драйвер asyncpg, минуя построение Row-объектов SQLAlchemy
+    на каждую строку. Общий путь для рассылок из планировщика и из админки.
     """
-    lead = await session.execute(select(LeadSource).where(LeadSource.name == lead_source_name))
-    lead_obj = lead.scalar_one_or_none()
-    if not lead_obj:
-        return
-
-    await session.execute(
-        update(User).where(User.user_id == user_tg_id).values(lead_source_id=lead_obj.id)
-    )
-    await session.commit()
+    conn = await session.connection()
+    raw_conn = await conn.get_raw_connection()
+    if lead_source_id is None:
+        records = await raw_conn.driver_connection.fetch(
+            'SELECT user_id FROM "user" WHERE user_id IS NOT NULL'
+        )
+    else:
+        records = await raw_conn.driver_connection.fetch(
+            'SELECT user_id FROM "user" WHERE user_id IS NOT NULL AND lead_source_id = $1',
+            lead_source_id,
+        )
+    return [record[0] for record in records]
 
 
 async def delete_user(session: AsyncSession, user_tg_id: int) -> None:
@@ -124,6 +283,7 @@ async def delete_user(session: AsyncSession, user_tg_id: int) -> None:
     """
     await session.execute(delete(User).where(User.user_id == user_tg_id))
     await session.commit()
+    user_count_cache.clear()
 
 
 # ==========================================================
@@ -135,17 +295,21 @@ async def add_message_schedule(
     message_text: str,
     scheduled_at: datetime,
     file_id: Optional[str] = None,
-    file_type: Optional[str] = None
+    file_type: Optional[str] = None,
+    commit: bool = True
 ):
-    """Создаёт запланированное сообщение. Картинка — ТОЛЬКО если передали file_id."""
+    """
+    Создаёт запланированное сообщение. Картинка — ТОЛЬКО если передали file_id.
+    commit=False — запись остаётся в текущей транзакции вызывающего кода.
+    """
     send_time = scheduled_at.replace(tzinfo=None)
     
     if file_id and file_type:
-        payload = json.dumps({
+        payload = orjson.dumps({
             "text": message_text,
             "file_id": file_id,
             "file_type": file_type
-        }, ensure_ascii=False)
+        }).decode()
     else:
         payload = message_text  
 
@@ -156,11 +320,26 @@ async def add_message_schedule(
         sent=False
     )
     session.add(schedule)
-    await session.commit()
-    await session.refresh(schedule)
+    await session.execute(NOTIFY_SCHEDULE_SQL)
+    if commit:
+        await session.commit()
     return schedule
 
 
+async def add_message_schedules_bulk(session: AsyncSession, rows: list[dict], commit: bool = True) -> None:
+    """
+    Создаёт пачку запланированных сообщений одним INSERT (executemany).
+    Каждая строка: {"user_id", "message_text", "send_time", "sent"}; send_time — naive.
+    commit=False — вставка остаётся в текущей транзакции вызывающего кода.
+    """
+    if not rows:
+        return
+    await session.execute(insert(MessageSchedule), rows)
+    await session.execute(NOTIFY_SCHEDULE_SQL)
+    if commit:
+        await session.commit()
+
+
 async def get_pending_messages(session: AsyncSession) -> list[MessageSchedule]:
     """
     Возвращает все сообщения, которые ещё не отправлены.
@@ -171,14 +350,13 @@ async def get_pending_messages(session: AsyncSession) -> list[MessageSchedule]:
     return result.scalars().all()
 
 
-async def mark_message_as_sent(session: AsyncSession, message_id: int) -> None:
+async def mark_messages_as_sent(session: AsyncSession, message_ids: list[int]) -> None:
     """
-    Помечает сообщение как отправленное.
+    Помечает пачку сообщений как отправленные одним UPDATE.
+    Весь список уходит одним параметром-массивом, поэтому лимит параметров не мешает.
+    Коммит — на стороне вызывающего кода.
     """
-    await session.execute(
-        update(MessageSchedule).where(MessageSchedule.id == message_id).values(sent=True)
-    )
-    await session.commit()
+    await session.execute(MARK_MSGS_SENT_SQL, {"ids": message_ids})
 
 
 async def delete_message_schedule(session: AsyncSession, message_id: int) -> None:
@@ -188,22 +366,16 @@ async def delete_message_schedule(session: AsyncSession, message_id: int) -> Non
     await session.execute(delete(MessageSchedule).where(MessageSchedule.id == message_id))
     await session.commit()
 
+
 async def get_all_users_paginated(session: AsyncSession, page: int = 1, per_page: int = 10) -> tuple[list[User], int]:
-    """Все пользователи с пагинацией."""
-    offset = (page - 1) * per_page
-    result = await session.execute(
-        select(User)
-        .options(joinedload(User.lead_source))
-        .order_by(User.registered_at.desc())
-        .limit(per_page)
-        .offset(offset)
-    )
-    users = result.scalars().unique().all()
-    
-    total_result = await session.execute(select(func.count()).select_from(User))
-    total = total_result.scalar()
-    
-    return users, total
+    """
+    Все пользователи с пагинацией.
+    Общее число берётся из кэша get_user_count — при листании выполняется только LIMIT/OFFSET.
+    """
+    total = await get_user_count(session)
+    stmt = select(User).options(*USER_LIST_OPTIONS).order_by(User.registered_at.desc())
+    rows, total = await paginate_query(session, stmt, page, per_page, total=total)
+    return [row.User for row in rows], total
 
 # ==========================================================
 # 4. BROADCAST — массовые рассылки
@@ -232,8 +404,9 @@ async def add_broadcast(
         target_lead_id=lead_source_id
     )
     session.add(broadcast)
+    if scheduled_at is not None:
+        await session.execute(NOTIFY_SCHEDULE_SQL)
     await session.commit()
-    await session.refresh(broadcast)
     return broadcast
 
 async def get_unsent_broadcasts(session: AsyncSession) -> list[Broadcast]:
@@ -265,94 +438,139 @@ async def delete_broadcast(session: AsyncSession, broadcast_id: int) -> None:
 
 
 async def get_lead_source_by_name(session: AsyncSession, name: str) -> Optional[LeadSource]:
-    query = select(LeadSource).where(LeadSource.name == name)
+    query = lambda_stmt(lambda: select(LeadSource).where(LeadSource.name == name))
     result = await session.execute(query)
     return result.scalar_one_or_none()
 
         
 
 async def get_lead_source_id_by_name(session: AsyncSession, name: str) -> Optional[int]:
-    """Получить ID источника лидов по имени."""
-    from app.database.models import LeadSource
-    result = await session.execute(
-        select(LeadSource.id).where(LeadSource.name == name)
-    )
-    return result.scalar_one_or_none()
+    """Получить ID источника лидов по имени (с кэшем в памяти)."""
+    async def _fetch() -> Optional[int]:
+        result = await session.execute(
+            select(LeadSource.id).where(LeadSource.name == name)
+        )
+        return result.scalar_one_or_none()
+
+    return await cached(lead_source_cache, ("id_by_name", name), _fetch)
 
 async def assign_user_to_lead_source(
     session: AsyncSession, 
     user_id: int, 
     lead_source_name: str
 ):
-    """Привязать пользователя к источнику лидов."""
+    """Привязать пользователя к источнику лидов. Коммит — на вызывающей стороне."""
     
-    lead_source = await session.get(LeadSource, 
-        (await get_lead_source_id_by_name(session, lead_source_name))
-    )
+    lead_source_id = await get_lead_source_id_by_name(session, lead_source_name)
     
-    if not lead_source:
-        logger.error(f"Lead source '{lead_source_name}' not found")
+    if lead_source_id is None:
+        logger.error("Lead source '%s' not found", lead_source_name)
         return False
 
     stmt = update(User).where(
         User.user_id == user_id
-    ).values(lead_source_id=lead_source.id)
+    ).values(lead_source_id=lead_source_id)
     
     result = await session.execute(stmt)
-    await session.commit()
     
     if result.rowcount > 0:
-        logger.info(f"User {user_id} assigned to lead source: {lead_source_name}")
+        logger.info("User %s assigned to lead source: %s", user_id, lead_source_name)
         return True
     else:
-        logger.error(f"User {user_id} not found")
+        logger.error("User %s not found", user_id)
         return False
     
     
     
-async def send_broadcast_now(session: AsyncSession, bot: Bot, broadcast_id: int):
-    """Отправка рассылки."""
-    broadcast = await session.get(Broadcast, broadcast_id)
-    if not broadcast:
-        return
-    
-    users = await get_users_by_lead_source(session, broadcast.target_lead_id) if broadcast.target_lead_id else await get_all_users(session)
-    
-    sent_count = 0
-    for user in users:
+async def _safe_send(send: Callable[[], Awaitable], tg_id: int) -> bool:
+    """
+    Выполняет отправку и разбирает ошибки Telegram по типу исключения.
+    Каждая попытка ждёт токен общего лимита telegram_bucket.
+    При флуд-контроле ждёт retry_after и повторяет запрос один раз.
+    """
+    for attempt in range(2):
         try:
-            if broadcast.file_type == "text":
-                await bot.send_message(user.user_id, broadcast.content)
-            elif broadcast.file_type == "image":
-                await bot.send_photo(user.user_id, broadcast.file_id)
-            elif broadcast.file_type == "file":
-                await bot.send_document(user.user_id, broadcast.file_id)
-            elif broadcast.file_type == "video":
-                await bot.send_video(user.user_id, broadcast.file_id)
-            
-            sent_count += 1
-            logger.info(f"✅ Отправлено {user.user_id} (#{broadcast.id})")
-            
+            await telegram_bucket.acquire()
+            await send()
+            return True
+        except TelegramRetryAfter as e:
+            if attempt:
+                logger.error("❌ Флуд-контроль, не отправлено %s", tg_id)
+                return False
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError:
+            logger.warning("Пользователь %s заблокировал бота", tg_id)
+            return False
+        except TelegramAPIError as e:
+            logger.error("❌ Ошибка %s: %s", tg_id, e)
+            return False
         except Exception as e:
-            logger.error(f"❌ Ошибка {user.user_id}: {e}")
-    
-    broadcast.status = "sent"
-    broadcast.is_sent = True
-    broadcast.sent_count = sent_count
-    await session.commit()
-    
-    broadcast.status = "sent"
-    broadcast.is_sent = True
-    broadcast.sent_count = sent_count
-    
-    await session.commit()
-    logger.info(f"✅ Рассылка #{broadcast.id} отправлена {sent_count} пользователям")
-    
-    
-    
-async def get_stage_text(session: AsyncSession, stage: str) -> Optional[StageText]:
-    result = await session.execute(select(StageText).where(StageText.stage == stage))
-    return result.scalar_one_or_none()
+            logger.exception("❌ Непредвиденная ошибка %s: %s", tg_id, e)
+            return False
+    return False
+
+
+async def send_broadcast_now(session_maker: async_sessionmaker, bot: Bot, broadcast_id: int):
+    """
+    Отправка рассылки. Одновременно идёт не больше одной рассылки,
+    чтобы параллельные запуски не делили между собой лимит Bot API.
+    Ни сессия, ни транзакция не держатся во время отправки: короткая транзакция
+    захватывает рассылку (status='sending') и читает получателей, вторая — записывает итог.
+    """
+    async with _broadcast_slot:
+        async with session_maker() as session, session.begin():
+            broadcast = (await session.execute(CLAIM_BROADCAST_SQL, {"id": broadcast_id})).first()
+            # Нет такой рассылки или её уже отправляют/отправили
+            user_ids = (
+                await _fetch_recipient_tg_ids(session, broadcast.target_lead_id)
+                if broadcast is not None else []
+            )
+        if broadcast is None:
+            return
+
+        file_type, file_id, content = broadcast.file_type, broadcast.file_id, broadcast.content
+
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+        async def _deliver(tg_id: int) -> None:
+            if file_type == "text":
+                await bot.send_message(tg_id, content)
+            elif file_type == "image":
+                await bot.send_photo(tg_id, file_id)
+            elif file_type == "file":
+                await bot.send_document(tg_id, file_id)
+            elif file_type == "video":
+                await bot.send_video(tg_id, file_id)
+
+        async def _send(tg_id: int) -> int:
+            async with semaphore:
+                if not await _safe_send(lambda: _deliver(tg_id), tg_id):
+                    return 0
+                logger.info("✅ Отправлено %s (#%s)", tg_id, broadcast_id)
+                return 1
+
+        sent_count = sum(await asyncio.gather(*[_send(tg_id) for tg_id in user_ids]))
+
+        async with session_maker() as session, session.begin():
+            await session.execute(MARK_BROADCAST_SENT_SQL, {"id": broadcast_id, "total": sent_count})
+        logger.info("✅ Рассылка #%s отправлена %s пользователям", broadcast_id, sent_count)
+
+
+def send_broadcast_in_background(session_maker: async_sessionmaker, bot: Bot, broadcast_id: int) -> None:
+    """
+    Запускает send_broadcast_now фоновой задачей — хендлер отвечает админу сразу,
+    не дожидаясь окончания рассылки. Сессии задача открывает сама и только на
+    короткие чтения/записи, поэтому соединение из пула на время отправки не занято.
+    """
+    async def _run() -> None:
+        try:
+            await send_broadcast_now(session_maker, bot, broadcast_id)
+        except Exception:
+            logger.exception("❌ Рассылка #%s прервана", broadcast_id)
+
+    task = asyncio.create_task(_run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
 
 async def get_all_stage_texts(session: AsyncSession) -> List[StageText]:
@@ -360,31 +578,20 @@ async def get_all_stage_texts(session: AsyncSession) -> List[StageText]:
     return result.scalars().all()
 
 
-async def update_stage_text(
-    session: AsyncSession,
-    stage: str,
-    welcome_text: Optional[str] = None,
-    main_menu_caption: Optional[str] = None
-) -> StageText:
-    stmt = update(StageText).where(StageText.stage == stage)
-    values = {}
-    if welcome_text is not None:
-        values["welcome_text"] = welcome_text
-    if main_menu_caption is not None:
-        values["main_menu_caption"] = main_menu_caption
-    if values:
-        stmt = stmt.values(**values)
-        await session.execute(stmt)
-        await session.commit()
-    
-    result = await session.execute(select(StageText).where(StageText.stage == stage))
-    return result.scalar_one()    
+# === StageText ===
+def _detached(session: AsyncSession, obj):
+    """Отвязывает объект от сессии, чтобы его можно было безопасно держать в кэше."""
+    if obj is not None:
+        session.expunge(obj)
+    return obj
 
 
-# === StageText ===
 async def get_stage_text(session: AsyncSession, stage: str) -> Optional[StageText]:
-    result = await session.execute(select(StageText).where(StageText.stage == stage))
-    return result.scalar_one_or_none()
+    async def _fetch() -> Optional[StageText]:
+        result = await session.execute(lambda_stmt(lambda: select(StageText).where(StageText.stage == stage)))
+        return _detached(session, result.scalar_one_or_none())
+
+    return await cached(stage_cache, ("stage_text", stage), _fetch)
 
 async def update_stage_text(
     session: AsyncSession,
@@ -402,13 +609,17 @@ async def update_stage_text(
             update(StageText).where(StageText.stage == stage).values(**values)
         )
         await session.commit()
+        stage_cache.invalidate(("stage_text", stage))
     result = await session.execute(select(StageText).where(StageText.stage == stage))
     return result.scalar_one()
 
 
 async def get_feedback_options(session: AsyncSession, stage: str = "stage3") -> Optional[FeedbackOptions]:
-    result = await session.execute(select(FeedbackOptions).where(FeedbackOptions.stage == stage))
-    return result.scalar_one_or_none()
+    async def _fetch() -> Optional[FeedbackOptions]:
+        result = await session.execute(lambda_stmt(lambda: select(FeedbackOptions).where(FeedbackOptions.stage == stage)))
+        return _detached(session, result.scalar_one_or_none())
+
+    return await cached(stage_cache, ("feedback", stage), _fetch)
 
 async def update_feedback_options(
     session: AsyncSession,
@@ -426,109 +637,101 @@ async def update_feedback_options(
             update(FeedbackOptions).where(FeedbackOptions.stage == stage).values(**values)
         )
         await session.commit()
+        stage_cache.invalidate(("feedback", stage))
     result = await session.execute(select(FeedbackOptions).where(FeedbackOptions.stage == stage))
     return result.scalar_one()
 
 
 logger = logging.getLogger(__name__)
 
-async def send_scheduled_broadcasts(session, bot):
-    
-    now = datetime.now(ZoneInfo("Asia/Almaty")).replace(tzinfo=None)
-    logger.info(f"Проверка рассылок: {now}")
+async def get_next_due_delay(session_maker: async_sessionmaker) -> Optional[float]:
+    """Секунды до ближайшего неотправленного сообщения или рассылки (< 0 — уже пора); None — очередь пуста."""
+    async with session_maker() as session:
+        return await session.scalar(NEXT_DUE_DELAY_SQL)
+
+
+async def send_scheduled_broadcasts(session_maker: async_sessionmaker, bot: Bot):
+    """
+    Один тик планировщика. Транзакция никогда не держится во время отправки в Telegram:
+    1) короткая транзакция захватывает наступившие задачи — сообщения сразу помечаются
+       отправленными, рассылки получают статус 'sending' — и коммитится;
+    2) отправка идёт без открытой транзакции;
+    3) итог каждой рассылки записывается своей короткой транзакцией.
+    Сбой посреди отправки не приводит к повторам: захваченное следующий тик не выберет.
+    """
+    logger.info("Проверка рассылок")
 
     # ========================================
-    # 1. ОТПРАВКА MessageSchedule (индивидуальные)
+    # 1. ЗАХВАТ наступивших задач
     # ========================================
-    query_personal = text("""
-        SELECT ms.id, ms.message_text, u.user_id as tg_id
-        FROM message_schedule ms
-        JOIN "user" u ON u.id = ms.user_id
-        WHERE ms.send_time <= :now 
-          AND ms.sent = false
-    """)
-
-    result = await session.execute(query_personal, {"now": now})
-    rows = result.fetchall()
-
-    for row in rows:
-        try:
-            await bot.send_message(
-                chat_id=row.tg_id,
-                text=row.message_text,
-                parse_mode="HTML",
-                disable_web_page_preview=True
-            )
-            logger.info(f"Отправлено пользователю {row.tg_id}")
-        except Exception as e:
-            if "blocked" in str(e).lower():
-                logger.warning(f"Пользователь {row.tg_id} заблокировал бота")
-            else:
-                logger.error(f"Ошибка отправки {row.tg_id}: {e}")
+    async with session_maker() as session, session.begin():
+        result = await session.execute(PENDING_MSGS_SQL)
+        rows = result.fetchall()
+        if rows:
+            await mark_messages_as_sent(session, [row.id for row in rows])
 
-        await session.execute(
-            text("UPDATE message_schedule SET sent = true WHERE id = :id"),
-            {"id": row.id}
-        )
+        result = await session.execute(CLAIM_BROADCASTS_SQL)
+        broadcasts = sorted(result.fetchall(), key=lambda b: b.scheduled_at)
+
+        # Получателей читаем один раз на тик — общий список для всех рассылок
+        user_ids = await _fetch_recipient_tg_ids(session) if broadcasts else []
 
     # ========================================
-    # 2. ОТПРАВКА Broadcast (массовые)
+    # 2. ОТПРАВКА MessageSchedule (индивидуальные)
     # ========================================
-    query_broadcast = text("""
-        SELECT id, title, content, file_id, file_type
-        FROM broadcast
-        WHERE scheduled_at <= :now
-          AND (status IS NULL OR status = 'pending')
-          AND is_sent = false
-        LIMIT 1
-    """)
+    # Параллельно, но не больше BROADCAST_CONCURRENCY в полёте и в темпе telegram_bucket
+    msg_semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def _send_scheduled(row) -> None:
+        async with msg_semaphore:
+            sent = await _safe_send(
+                lambda: bot.send_message(
+                    chat_id=row.tg_id,
+                    text=row.message_text,
+                    parse_mode="HTML",
+                    disable_web_page_preview=True
+                ),
+                row.tg_id,
+            )
+        if sent:
+            logger.info("Отправлено пользователю %s", row.tg_id)
 
-    result = await session.execute(query_broadcast, {"now": now})
-    broadcast = result.fetchone()
+    await asyncio.gather(*[_send_scheduled(row) for row in rows])
 
-    if broadcast:
-        logger.info(f"Начинаем массовую рассылку: {broadcast.title}")
-        await session.execute(
-            text("UPDATE broadcast SET status = 'sending' WHERE id = :id"),
-            {"id": broadcast.id}
-        )
-        await session.commit()
+    # ========================================
+    # 3. ОТПРАВКА Broadcast (массовые)
+    # ========================================
+    for broadcast in broadcasts:
+        logger.info("Начинаем массовую рассылку: %s", broadcast.title)
 
         # Отправляем ВСЕМ активным пользователям
-        users_query = text("SELECT user_id FROM \"user\" WHERE user_id IS NOT NULL")
-        users = await session.execute(users_query)
-        total = 0
-        for user_row in users:
-            try:
-                if broadcast.file_id and broadcast.file_type:
-                    await bot.send_document(
-                        chat_id=user_row.user_id,
-                        document=broadcast.file_id,
-                        caption=broadcast.content,
-                        parse_mode="HTML"
-                    )
-                else:
-                    await bot.send_message(
-                        chat_id=user_row.user_id,
-                        text=broadcast.content or broadcast.title,
-                        parse_mode="HTML"
-                    )
-                total += 1
-            except Exception as e:
-                if "blocked" not in str(e).lower():
-                    logger.error(f"Не отправлено {user_row.user_id}: {e}")
-
-        await session.execute(text("""
-            UPDATE broadcast 
-            SET is_sent = true, 
-                status = 'sent', 
-                sent_count = :total,
-                updated = :now
-            WHERE id = :id
-        """), {"id": broadcast.id, "total": total, "now": now})
-        logger.info(f"Рассылка завершена: {total} отправлено")
-
-    if rows or broadcast:
-        await session.commit()
-        
-        
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+        async def _deliver(tg_id: int) -> None:
+            if broadcast.file_id and broadcast.file_type:
+                await bot.send_document(
+                    chat_id=tg_id,
+                    document=broadcast.file_id,
+                    caption=broadcast.content,
+                    parse_mode="HTML"
+                )
+            else:
+                await bot.send_message(
+                    chat_id=tg_id,
+                    text=broadcast.content or broadcast.title,
+                    parse_mode="HTML"
+                )
+
+        async def _send(tg_id: int) -> int:
+            async with semaphore:
+                return int(await _safe_send(lambda: _deliver(tg_id), tg_id))
+
+        results = await asyncio.gather(*[_send(tg_id) for tg_id in user_ids])
+        total = sum(results)
+
+        async with session_maker() as session, session.begin():
+            await session.execute(
+                MARK_BROADCAST_SENT_SQL,
+                {"id": broadcast.id, "total": total},
+            )
+        logger.info("Рассылка завершена: %s отправлено", total)
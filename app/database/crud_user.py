@@ -2,11 +2,17 @@ from datetime import datetime
 import math
 import random
 from typing import List, Optional
-from sqlalchemy import select, func, update
+from sqlalchemy import lambda_stmt, literal_column, select, func, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import selectinload
 
 from app.database.models import LeadSource, User, MessageSchedule, Broadcast
+from app.utils.cache import TTLCache, cached
+
+
+# Число пользователей для админки: точность до пары десятков секунд достаточна
+user_count_cache = TTLCache(ttl=30, maxsize=1)
 
 
 # ----------------------------------------------------------
@@ -14,7 +20,7 @@ from app.database.models import LeadSource, User, MessageSchedule, Broadcast
 # ----------------------------------------------------------
 async def get_user_registered_at(session: AsyncSession, tg_user_id: int) -> Optional[datetime]:
     """Возвращает дату регистрации пользователя или None, если пользователь не найден."""
-    query = select(User.registered_at).where(User.user_id == tg_user_id)
+    query = lambda_stmt(lambda: select(User.registered_at).where(User.user_id == tg_user_id))
     result = await session.execute(query)
     return result.scalar_one_or_none()
 
@@ -42,20 +48,16 @@ async def add_user(
     first_name: Optional[str] = None,
     last_name: Optional[str] = None,
     phone: Optional[str] = None,
-    lead_source_id: Optional[int] = None
+    lead_source_id: Optional[int] = None,
+    commit: bool = True
 ) -> User:
     """
-    Добавляет нового пользователя, если его нет в БД.
-    Если пользователь уже существует — возвращает существующую запись.
+    Добавляет нового пользователя или обновляет username/имя существующего —
+    один запрос INSERT ... ON CONFLICT DO UPDATE ... RETURNING.
+    commit=False — запись остаётся в текущей транзакции вызывающего кода;
+    кэш счётчика пользователей тогда сбрасывает вызывающий код после своего коммита.
     """
-    query = select(User).where(User.user_id == user_id)
-    result = await session.execute(query)
-    user = result.scalar_one_or_none()
-
-    if user:
-        return user
-
-    new_user = User(
+    stmt = pg_insert(User).values(
         user_id=user_id,
         username=username,
         first_name=first_name,
@@ -63,24 +65,52 @@ async def add_user(
         phone=phone,
         lead_source_id=lead_source_id,
     )
+    stmt = (
+        stmt.on_conflict_do_update(
+            index_elements=[User.user_id],
+            set_={
+                "username": stmt.excluded.username,
+                "first_name": stmt.excluded.first_name,
+                "last_name": stmt.excluded.last_name,
+                # onupdate колонки в ON CONFLICT не подставляется автоматически
+                "updated": func.now(),
+            },
+        )
+        # xmax = 0 только у только что вставленной строки
+        .returning(User, literal_column("xmax = 0").label("inserted"))
+        .execution_options(populate_existing=True)
+    )
+    user, inserted = (await session.execute(stmt)).one()
+
+    if commit:
+        await session.commit()
+        if inserted:
+            user_count_cache.clear()
+    return user
 
-    session.add(new_user)
-    await session.commit()
-    await session.refresh(new_user)
 
-    return new_user
+async def get_user_count(session: AsyncSession) -> int:
+    """Количество пользователей — COUNT(*) в БД с коротким кэшем, без загрузки строк."""
+    async def _fetch() -> int:
+        return await session.scalar(select(func.count(User.id)))
+
+    return await cached(user_count_cache, "count", _fetch)
 
 
 async def get_user_by_id(session: AsyncSession, user_id: int) -> Optional[User]:
     """Возвращает объект пользователя по Telegram ID."""
-    query = select(User).where(User.user_id == user_id)
+    query = lambda_stmt(lambda: select(User).where(User.user_id == user_id))
     result = await session.execute(query)
     return result.scalar_one_or_none()
 
 
 async def get_users_by_lead_source(session: AsyncSession, lead_source_id: int) -> List[User]:
-    """Возвращает список пользователей, относящихся к указанному источнику лида."""
-    query = select(User).where(User.lead_source_id == lead_source_id)
+    """Возвращает список пользователей, относящихся к указанному источнику лида (с источником)."""
+    query = (
+        select(User)
+        .where(User.lead_source_id == lead_source_id)
+        .options(selectinload(User.lead_source))
+    )
     result = await session.execute(query)
     return result.scalars().all()
 
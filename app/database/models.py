@@ -1,9 +1,10 @@
 from datetime import datetime
+from functools import lru_cache
 from sqlalchemy import (
-    BigInteger, String, Integer, Text, ForeignKey, DateTime, Enum, Boolean, func
+    BigInteger, String, Integer, Text, ForeignKey, DateTime, Enum, Boolean, Index, func, text
 )
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine, async_sessionmaker
 from dotenv import load_dotenv
 import enum
 import os
@@ -17,13 +18,55 @@ load_dotenv()
 # URL для подключения к БД (формат postgresql+asyncpg)
 DATABASE_URL = os.getenv("SQLALCHEMY_URL")
 
+# Режим отладки: ленивые загрузки связей в списках превращаются в ошибки
+DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+
 # ---------------------------------------------------------------------
 # Инициализация асинхронного движка и пула сессий SQLAlchemy
 # ---------------------------------------------------------------------
-engine = create_async_engine(
-    DATABASE_URL,
-    echo=True  
-)
+# Лог SQL включается только явно (SQL_ECHO=true) — в проде он съедает CPU на каждом запросе
+SQL_ECHO = os.getenv("SQL_ECHO", "false").lower() == "true"
+
+# Параметры пула соединений — переопределяются через .env под нагрузку конкретного сервера
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "30"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Таймаут одного запроса asyncpg: зависший запрос не держит соединение из пула бесконечно
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "60"))
+# Сколько хендлеров выполняется одновременно (ConcurrencyLimitMiddleware): по умолчанию —
+# ёмкость пула минус запас под фоновые задачи (планировщик, статистика), чтобы лишние
+# апдейты ждали в очереди, а не падали по DB_POOL_TIMEOUT в ожидании соединения
+DB_MAX_HANDLERS = int(os.getenv("DB_MAX_HANDLERS", str(max(1, DB_POOL_SIZE + DB_MAX_OVERFLOW - 5))))
+
+
+@lru_cache(maxsize=1)
+def get_engine() -> AsyncEngine:
+    """Единственный движок на процесс: один пул соединений на всё приложение."""
+    return create_async_engine(
+        DATABASE_URL,
+        echo=SQL_ECHO,
+        echo_pool=False,
+        query_cache_size=1200,
+        # Пул под рассылки: много одновременных сессий без ожидания соединения
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        connect_args={
+            "command_timeout": DB_COMMAND_TIMEOUT,
+            # JIT Postgres только замедляет короткие OLTP-запросы бота
+            "server_settings": {"jit": "off"},
+            # Кэш подготовленных запросов на соединение: asyncpg (сырые запросы)
+            # и диалект SQLAlchemy — повторные запросы не парсятся и не планируются заново
+            "statement_cache_size": 1024,
+            "prepared_statement_cache_size": 1024,
+        }
+    )
+
+
+engine = get_engine()
 
 # Пул асинхронных сессий для безопасной работы с БД
 async_session_maker = async_sessionmaker(
@@ -120,6 +163,10 @@ class User(Base):
 # =====================================================================
 class MessageSchedule(Base):
     __tablename__ = "message_schedule"
+    __table_args__ = (
+        # Частичный индекс под планировщик: только ещё не отправленные сообщения
+        Index("idx_msg_sched_pending", "send_time", postgresql_where=text("sent = false")),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"))
@@ -141,6 +188,13 @@ class MessageSchedule(Base):
 # =====================================================================
 class Broadcast(Base):
     __tablename__ = "broadcast"
+    __table_args__ = (
+        # Частичный индекс под планировщик: только ожидающие рассылки
+        Index(
+            "idx_broadcast_pending", "scheduled_at",
+            postgresql_where=text("is_sent = false AND (status IS NULL OR status = 'pending')")
+        ),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     title: Mapped[str] = mapped_column(String(100), nullable=False)
@@ -185,4 +239,24 @@ class FeedbackOptions(Base):
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), onupdate=func.now())
 
     def __repr__(self) -> str:
-        return f"<FeedbackOptions stage={self.stage}>"
\ No newline at end of file
+        return f"<FeedbackOptions stage={self.stage}>"
+
+
+# =====================================================================
+# Модель: LeadMagnetStat
+# ---------------------------------------------------------------------
+# Статистика лид-магнита: выдача урока и отзывы пользователей.
+# Пишется пачками через StatBatcher (app/utils/stat_batcher.py).
+# =====================================================================
+class LeadMagnetStat(Base):
+    __tablename__ = "lead_magnet_stat"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, index=True, nullable=False)  # Telegram ID
+    template_version: Mapped[str] = mapped_column(String(10), nullable=False)
+    stage: Mapped[str] = mapped_column(String(20), nullable=False)
+    viewed: Mapped[bool] = mapped_column(Boolean, default=False)
+    feedback_type: Mapped[str] = mapped_column(String(50), nullable=True)
+
+    def __repr__(self) -> str:
+        return f"<LeadMagnetStat user={self.user_id} stage={self.stage}>"
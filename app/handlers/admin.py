@@ -1,37 +1,42 @@
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
 import logging
+import re
+import time
+from string import Template
 from zoneinfo import ZoneInfo
 
 from aiogram import F, Bot, Router, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, Message, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from sqlalchemy import select
+from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload, selectinload
 
 
 from app.database.state import AdminState  
-from app.database.models import LeadSource, User
+from app.database.models import LeadSource, User, async_session_maker
 from app.database.crud_admin import (
     # Источники лидов
     create_empty_lead_source,
     get_all_users_paginated,
     get_feedback_options,
     get_stage_text,
-    send_broadcast_now,
+    send_broadcast_in_background,
     update_feedback_options,
     update_lead_description,
     get_lead_sources,
+    get_lead_sources_with_counts,
+    lead_source_cache,
     delete_lead_source,
     get_lead_source_by_name,
 
     
     # Пользователи
-    get_all_users,
     get_users_by_lead_source,
     
     # Персональные сообщения
@@ -46,19 +51,59 @@ from app.database.crud_admin import (
     update_stage_text,
 )
 
+from app.database.crud_user import get_user_count
+
+from app.kbds.callbacks import EditTextCb, LeadCb
 from app.kbds.kbds import (
     DynamicKeyboards,
     AdminKeyboards,
     ReplyKeyboards
 )
 
+from app.middlewares.throttling import ThrottlingMiddleware
+from app.utils.cache import cached, single_flight
 from app.utils.filters import IsAdmin
-from app.utils.paginator import validate_lead_name, paginate 
+from app.utils.paginator import validate_lead_name
 
 logger = logging.getLogger(__name__)
 admin_router = Router()
 admin_router.message.filter(IsAdmin())
 admin_router.callback_query.filter(IsAdmin())
+admin_router.callback_query.middleware(ThrottlingMiddleware())
+
+
+@lru_cache(maxsize=4)
+def _fmt_minute(minute: int, fmt: str) -> str:
+    return datetime.fromtimestamp(minute * 60).strftime(fmt)
+
+
+def _fmt_now(fmt: str = "%d.%m.%Y %H:%M") -> str:
+    """Текущее время строкой; strftime вызывается не чаще раза в минуту на формат."""
+    return _fmt_minute(int(time.time()) // 60, fmt)
+
+
+def _fmt_dt(dt: datetime) -> str:
+    """Дата в формате ДД.ММ.ГГГГ ЧЧ:ММ без strftime — для построчного вывода списков."""
+    return f"{dt.day:02d}.{dt.month:02d}.{dt.year} {dt.hour:02d}:{dt.minute:02d}"
+
+
+async def _edit_or_answer(
+    callback: CallbackQuery,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+    parse_mode: Optional[str] = "HTML"
+) -> None:
+    """
+    Навигация по инлайн-меню: редактирует текущее сообщение вместо отправки нового.
+    Если сообщение нельзя отредактировать (фото, слишком старое) — отправляет новое.
+    """
+    try:
+        await callback.message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return
+        await callback.message.answer(text, reply_markup=reply_markup, parse_mode=parse_mode)
+
 
 # =============================================================================
 # ОСНОВНОЕ АДМИН МЕНЮ
@@ -87,6 +132,14 @@ LEAD_SOURCE_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="🔙 В меню", callback_data="admin_main")]
 ])
 
+# Русские названия воронок → служебные (deep-link) имена, замена за один проход
+_LEAD_NAME_MAP = {
+    "вебинар": "webinar",
+    "челлендж": "challenge",
+    "лид-магнит": "lead_magnet",
+}
+_LEAD_NAME_RE = re.compile("|".join(map(re.escape, _LEAD_NAME_MAP)))
+
 @admin_router.message(F.text == "📋 Источники лидов")
 async def lead_source_menu(message: Message, state: FSMContext):
     """Меню управления источниками лидов."""
@@ -125,9 +178,7 @@ async def create_lead_source_name(message: Message, state: FSMContext, session:
         )
         return
     
-    name_lower = name.lower().replace("вебинар", "webinar") \
-                           .replace("челлендж", "challenge") \
-                           .replace("лид-магнит", "lead_magnet")
+    name_lower = _LEAD_NAME_RE.sub(lambda m: _LEAD_NAME_MAP[m.group(0)], name.lower())
     
     try:
         lead = await create_empty_lead_source(session, name_lower)  
@@ -150,55 +201,53 @@ async def create_lead_source_description(message: Message, state: FSMContext, se
     description = message.text.strip()
     data = await state.get_data()
     
-    await update_lead_description(session, data['lead_id'], description)
-    
-    lead = await session.get(LeadSource, data['lead_id'])
+    lead = await update_lead_description(session, data['lead_id'], description)
     
     await message.answer(
         f"✅ <b>Источник лидов успешно создан</b>\n\n"
         f"📋 <b>Название:</b> {lead.name}\n"
         f"📝 <b>Описание:</b> {lead.description or 'Не указано'}\n"
-        f"🆔 <b>ID:</b> <code>{lead.id}</code>",
+        f"🆔 <b>ID:</b> <code>{data['lead_id']}</code>",
         reply_markup=ADMIN_MAIN_KB,
         parse_mode="HTML"
     )
     await state.clear()
 
 
+def _format_lead_sources(leads: list[tuple[LeadSource, int]]) -> str:
+    """Текст страницы источников лидов: собираем части и склеиваем один раз."""
+    parts = ["📋 <b>Источники лидов</b>\n\n"]
+    parts.extend(
+        f"{i}. <b>{lead.name}</b>\n"
+        f"   Описание: {lead.description or '—'}\n"
+        f"   Пользователей: <code>{users_count}</code>\n\n"
+        for i, (lead, users_count) in enumerate(leads, 1)
+    )
+    return "".join(parts)
+
+
 @admin_router.callback_query(AdminState.lead_source_menu, F.data == "view_leads")
 async def view_lead_sources(callback: CallbackQuery, session: AsyncSession):
     """Просмотр всех источников лидов с пагинацией."""
-    result = await session.execute(
-        select(LeadSource).options(joinedload(LeadSource.users))
-    )
-    leads = result.scalars().unique().all()
+    page = 1
+    leads, total = await get_lead_sources_with_counts(session, page, per_page=5)
     
     if not leads:
         await callback.message.answer("📭 Источники лидов не найдены")
         await callback.answer()
         return
     
-    page = 1
-    paginated = paginate(leads, page, per_page=5)
+    pages = (total + 4) // 5
     
-    text = "📋 <b>Источники лидов</b>\n\n"
-    for i, lead in enumerate(paginated['items'], 1):
-        users_count = len(lead.users)  
-        text += f"{i}. <b>{lead.name}</b>\n"
-        text += f"   Описание: {lead.description or '—'}\n"
-        text += f"   Пользователей: <code>{users_count}</code>\n\n"
+    text = _format_lead_sources(leads)
     
     # Клавиатура пагинации
-    kb = DynamicKeyboards.pagination(page, paginated['pages'])
+    kb = DynamicKeyboards.pagination(page, pages)
     kb.inline_keyboard.append([
         InlineKeyboardButton(text="🔙 Назад", callback_data="admin_main")
     ])
     
-    await callback.message.answer(
-        text,
-        reply_markup=kb,
-        parse_mode="HTML"
-    )
+    await _edit_or_answer(callback, text, kb)
     await callback.answer()
 
 # =============================================================================
@@ -210,6 +259,8 @@ MESSAGE_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="🔙 В меню", callback_data="admin_main")]
 ])
 
+PERSONAL_MSG_KB = AdminKeyboards.personal_message()
+
 @admin_router.message(F.text == "📨 Персональные сообщения")
 async def message_schedule_menu(message: Message, state: FSMContext):
     await state.set_state(AdminState.message_schedule_menu)
@@ -230,24 +281,33 @@ async def send_message_start(callback: CallbackQuery, session: AsyncSession, sta
         await callback.answer()
         return
     
-    await show_users_paginated(callback, users, total, page=1, state=state)
+    await show_users_paginated(callback, users, total, page=1, state=state, edit=False)
     await state.set_state(AdminState.message_users_page)
     await callback.answer()
 
 
-async def show_users_paginated(callback: CallbackQuery, users: list[User], total: int, page: int, state: FSMContext):
-    """Показать страницу пользователей."""
+async def show_users_paginated(
+    callback: CallbackQuery,
+    users: list[User],
+    total: int,
+    page: int,
+    state: FSMContext,
+    edit: bool = True,
+):
+    """Показать страницу пользователей. При листании редактируем текущее сообщение."""
     per_page = 10
     total_pages = (total + per_page - 1) // per_page
     
-    text = f"👥 <b>Выберите пользователя (страница {page}/{total_pages})</b>\n\n"
+    parts = [f"👥 <b>Выберите пользователя (страница {page}/{total_pages})</b>\n\n"]
     inline_keyboard = []
     
     for i, user in enumerate(users, (page - 1) * per_page + 1):
         lead_name = user.lead_source.name if user.lead_source else "—"
         name = f"{user.first_name or ''} {user.last_name or ''}".strip() or f"ID {user.user_id}"
-        text += f"{i}. <code>{user.user_id}</code> — {name}\n"
-        text += f"   Источник: <b>{lead_name}</b>\n\n"
+        parts.append(
+            f"{i}. <code>{user.user_id}</code> — {name}\n"
+            f"   Источник: <b>{lead_name}</b>\n\n"
+        )
         
         button_text = f"📨 {name[:20]}"
         inline_keyboard.append([
@@ -284,53 +344,41 @@ async def show_users_paginated(callback: CallbackQuery, users: list[User], total
     ])
     
     kb = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+    text = "".join(parts)
     
-    await callback.message.answer(
-        text, 
-        reply_markup=kb, 
-        parse_mode="HTML"
-    )
+    if edit:
+        await _edit_or_answer(callback, text, kb)
+    else:
+        await callback.message.answer(text, reply_markup=kb, parse_mode="HTML")
     
 # --- ПАГИНАЦИЯ ---
 @admin_router.callback_query(F.data.startswith("page_leads_"))
 async def leads_pagination(callback: CallbackQuery, session: AsyncSession):
     """Переход по страницам источников лидов."""
-    page = int(callback.data.split("_")[-1])
-    result = await session.execute(
-        select(LeadSource).options(joinedload(LeadSource.users))
-    )
-    leads = result.scalars().unique().all()
+    page = int(callback.data.removeprefix("page_leads_"))
+    leads, total = await get_lead_sources_with_counts(session, page, per_page=5)
     
     if not leads:
         await callback.message.answer("📭 Источники лидов не найдены")
         await callback.answer()
         return
     
-    paginated = paginate(leads, page, per_page=5)
-    text = "📋 <b>Источники лидов</b>\n\n"
-    for i, lead in enumerate(paginated['items'], 1):
-        users_count = len(lead.users) if lead.users else 0
-        text += f"{i}. <b>{lead.name}</b>\n"
-        text += f"   Описание: {lead.description or '—'}\n"
-        text += f"   Пользователей: <code>{users_count}</code>\n\n"
+    pages = (total + 4) // 5
+    text = _format_lead_sources(leads)
     
-    kb = DynamicKeyboards.pagination(page, paginated['pages'])
+    kb = DynamicKeyboards.pagination(page, pages)
     kb.inline_keyboard.append([
         InlineKeyboardButton(text="🔙 Назад", callback_data="admin_main")
     ])
     
-    await callback.message.edit_text(
-        text,
-        reply_markup=kb,
-        parse_mode="HTML"
-    )
+    await _edit_or_answer(callback, text, kb)
     await callback.answer()    
     
     
 @admin_router.callback_query(AdminState.message_users_page, F.data.startswith("users_page_"))
 async def users_pagination(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
     """Переход по страницам пользователей."""
-    page = int(callback.data.split("_")[-1])
+    page = int(callback.data.removeprefix("users_page_"))
     users, total = await get_all_users_paginated(session, page)
     await show_users_paginated(callback, users, total, page, state)
     await callback.answer()
@@ -339,7 +387,7 @@ async def users_pagination(callback: CallbackQuery, session: AsyncSession, state
 @admin_router.callback_query(F.data.startswith("select_user_"))
 async def select_user_for_message(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
     """Выбор → выбор типа сообщения."""
-    db_user_id = int(callback.data.split("_")[-1])
+    db_user_id = int(callback.data.removeprefix("select_user_"))
     user = await session.get(User, db_user_id)
     
     if not user:
@@ -358,50 +406,49 @@ async def select_user_for_message(callback: CallbackQuery, session: AsyncSession
     await callback.message.answer(
         f"👤 <b>Выбран:</b> <code>{user.user_id}</code> — {user.first_name or 'Без имени'}\n\n"
         "📢 <b>Выберите тип сообщения:</b>",
-        reply_markup=AdminKeyboards.personal_message(),  
+        reply_markup=PERSONAL_MSG_KB,
         parse_mode="HTML"
     )
     await state.set_state(AdminState.add_message_type)  
     await callback.answer()
 
 # --- ВЫБОР ТИПА → СОДЕРЖИМОЕ ---
-@admin_router.callback_query(AdminState.add_message_type, F.data == "message_text")
-async def message_text_start(callback: CallbackQuery, state: FSMContext):
-    """Текст → ввод текста."""
-    await callback.message.answer("📝 <b>Введите текст сообщения:</b>")
-    await state.set_state(AdminState.add_message_text)
-    await callback.answer()
-
-
-@admin_router.callback_query(AdminState.add_message_type, F.data == "message_image")
-async def message_image_start(callback: CallbackQuery, state: FSMContext):
-    """Картинка → отправка фото."""
-    await callback.message.answer("🖼️ <b>Отправьте картинку:</b>")
-    await state.set_state(AdminState.add_message_image)
+VIDEO_PROMPT = "🎥 <b>Отправьте видео:</b>\n\n<i>Макс. 50 МБ, форматы: MP4</i>"
+
+# callback_data → (подсказка, следующее состояние)
+MESSAGE_TYPE_PROMPTS = {
+    "message_text": ("📝 <b>Введите текст сообщения:</b>", AdminState.add_message_text),
+    "message_image": ("🖼️ <b>Отправьте картинку:</b>", AdminState.add_message_image),
+    "message_file": ("📎 <b>Отправьте файл:</b>", AdminState.add_message_file),
+    "message_video": (VIDEO_PROMPT, AdminState.add_message_video),
+}
+
+
+@admin_router.callback_query(AdminState.add_message_type, F.data.in_(MESSAGE_TYPE_PROMPTS.keys()))
+async def message_type_start(callback: CallbackQuery, state: FSMContext):
+    """Тип сообщения → запрос контента."""
+    prompt, next_state = MESSAGE_TYPE_PROMPTS[callback.data]
+    await callback.message.answer(prompt)
+    await state.set_state(next_state)
     await callback.answer()
 
+MAX_VIDEO_SIZE = 50 * 1024 * 1024
 
-@admin_router.callback_query(AdminState.add_message_type, F.data == "message_file")
-async def message_file_start(callback: CallbackQuery, state: FSMContext):
-    """Файл → отправка файла."""
-    await callback.message.answer("📎 <b>Отправьте файл:</b>")
-    await state.set_state(AdminState.add_message_file)
-    await callback.answer()
 
+def _video_error(video: types.Video) -> Optional[str]:
+    """Проверка видео на входе: то, что Telegram всё равно отклонит, отсекаем сразу."""
+    if video.file_size and video.file_size > MAX_VIDEO_SIZE:
+        return "❌ Видео больше 50 МБ"
+    if video.mime_type and video.mime_type != "video/mp4":
+        return "❌ Поддерживается только MP4"
+    return None
 
-@admin_router.callback_query(AdminState.add_message_type, F.data == "message_video")
-async def message_video_start(callback: CallbackQuery, state: FSMContext):
-    """Видео → отправка видео."""
-    await callback.message.answer("🎥 <b>Отправьте видео:</b>\n\n<i>Макс. 50 МБ, форматы: MP4</i>")
-    await state.set_state(AdminState.add_message_video)  
-    await callback.answer()
 
 # --- ОБРАБОТКА КОНТЕНТА ---
 @admin_router.message(AdminState.add_message_text)
 async def create_message_text(message: Message, state: FSMContext):
     """Текст → отправка."""
-    await state.update_data(content=message.text)
-    await send_message_final(message, state, message.bot)
+    await send_message_final(message, state, message.bot, content=message.text)
 
 
 @admin_router.message(AdminState.add_message_image)
@@ -411,9 +458,11 @@ async def create_message_image(message: Message, state: FSMContext, bot: Bot):
         await message.answer("❌ Отправьте картинку!")
         return
     
-    file_id = message.photo[-1].file_id
-    await state.update_data(file_id=file_id, content_type="image")
-    await send_message_final(message, state, bot)
+    await send_message_final(
+        message, state, bot,
+        file_id=message.photo[-1].file_id,
+        content_type="image"
+    )
 
 
 @admin_router.message(AdminState.add_message_file)
@@ -423,13 +472,11 @@ async def create_message_file(message: Message, state: FSMContext, bot: Bot):
         await message.answer("❌ Отправьте файл!")
         return
     
-    file_id = message.document.file_id
-    await state.update_data(
-        file_id=file_id, 
-        content_type="file",
-        file_name=message.document.file_name
+    await send_message_final(
+        message, state, bot,
+        file_id=message.document.file_id,
+        content_type="file"
     )
-    await send_message_final(message, state, bot)
 
 @admin_router.message(AdminState.add_message_video)
 async def create_message_video(message: Message, state: FSMContext, bot: Bot):
@@ -438,23 +485,41 @@ async def create_message_video(message: Message, state: FSMContext, bot: Bot):
         await message.answer("❌ Отправьте видео!")
         return
     
-    file_id = message.video.file_id
-    await state.update_data(
-        file_id=file_id,
-        content_type="video",
-        file_name=message.video.file_name or "video.mp4"
+    if error := _video_error(message.video):
+        await message.answer(error)
+        return
+    
+    await send_message_final(
+        message, state, bot,
+        file_id=message.video.file_id,
+        content_type="video"
     )
-    await send_message_final(message, state, bot)
 
 
-async def send_message_final(message: Message, state: FSMContext, bot: Bot):
-    """Общая логика отправки."""
+_SENT_TMPL = Template(
+    "✅ <b>Сообщение ОТПРАВЛЕНО!</b>\n\n"
+    "👤 <b>$name</b>\n"
+    "🆔 <code>$uid</code>\n"
+    "📢 <b>Тип:</b> $ctype\n"
+    "🕐 $ts"
+)
+
+
+async def send_message_final(
+    message: Message,
+    state: FSMContext,
+    bot: Bot,
+    content: str = "",
+    file_id: Optional[str] = None,
+    content_type: str = "text",
+):
+    """
+    Общая логика отправки.
+    Контент приходит аргументами — из состояния читаем только выбранного пользователя.
+    """
     data = await state.get_data()
     telegram_user_id = data['selected_user_id']
     user_name = data['selected_user_name']
-    content = data.get('content', '')
-    file_id = data.get('file_id')
-    content_type = data.get('content_type', 'text')
     
     try:
         if content_type == "text":
@@ -467,18 +532,16 @@ async def send_message_final(message: Message, state: FSMContext, bot: Bot):
             await bot.send_video(chat_id=telegram_user_id, video=file_id)
         
         await message.answer(
-            f"✅ <b>Сообщение ОТПРАВЛЕНО!</b>\n\n"
-            f"👤 <b>{user_name}</b>\n"
-            f"🆔 <code>{telegram_user_id}</code>\n"
-            f"📢 <b>Тип:</b> {content_type}\n"
-            f"🕐 {datetime.now().strftime('%d.%m.%Y %H:%M')}",
+            _SENT_TMPL.substitute(
+                name=user_name, uid=telegram_user_id, ctype=content_type, ts=_fmt_now()
+            ),
             reply_markup=ADMIN_MAIN_KB,
             parse_mode="HTML"
         )
         await state.clear()
         
     except Exception as e:
-        logger.error(f"Ошибка отправки {telegram_user_id}: {e}")
+        logger.error("Ошибка отправки %s: %s", telegram_user_id, e)
         await message.answer(f"❌ Ошибка отправки: {e}")
         
 # =============================================================================
@@ -490,6 +553,8 @@ BROADCAST_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="🔙 В меню", callback_data="admin_main")]
 ])
 
+BROADCAST_TYPE_KB = AdminKeyboards.broadcast_type_menu()
+
 @admin_router.message(F.text == "📢 Массовая рассылка")
 async def broadcast_menu(message: Message, state: FSMContext):
     """Меню массовой рассылки."""
@@ -501,20 +566,30 @@ async def broadcast_menu(message: Message, state: FSMContext):
         parse_mode="HTML"
     )
 
+async def _broadcast_audience_kb(session: AsyncSession) -> InlineKeyboardMarkup:
+    """
+    Клавиатура выбора аудитории рассылки. Хранится в lead_source_cache рядом со списком
+    источников и сбрасывается вместе с ним при любом изменении источников.
+    """
+    async def _build() -> InlineKeyboardMarkup:
+        leads = await get_lead_sources(session)
+        inline_keyboard = [
+            [InlineKeyboardButton(text=lead.name, callback_data=f"select_lead_{lead.id}")]
+            for lead in leads
+        ]
+        inline_keyboard.extend([
+            [InlineKeyboardButton(text="📢 Всем пользователям", callback_data="broadcast_all")],
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_main")]
+        ])
+        return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+
+    return await cached(lead_source_cache, "broadcast_audience_kb", _build)
+
+
 @admin_router.callback_query(AdminState.broadcast_menu, F.data == "create_broadcast")
 async def create_broadcast_start(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
     """Шаг 1: Выбор аудитории."""
-    leads = await get_lead_sources(session)
-    
-    inline_keyboard = []
-    for lead in leads:
-        inline_keyboard.append([InlineKeyboardButton(text=lead.name, callback_data=f"select_lead_{lead.id}")])
-    inline_keyboard.extend([
-        [InlineKeyboardButton(text="📢 Всем пользователям", callback_data="broadcast_all")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_main")]
-    ])
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+    kb = await _broadcast_audience_kb(session)
     
     await callback.message.answer(
         "📢 <b>Создать массовую рассылку</b>\n\n"
@@ -529,15 +604,15 @@ async def create_broadcast_start(callback: CallbackQuery, session: AsyncSession,
 @admin_router.callback_query(AdminState.add_broadcast_lead_source, F.data.startswith("select_lead_"))
 async def create_broadcast_select_lead(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Выбор сегмента → тип контента."""
-    lead_id = int(callback.data.split("_")[-1])
-    lead = await session.get(LeadSource, lead_id)
+    lead_id = int(callback.data.removeprefix("select_lead_"))
+    lead_name = await session.scalar(select(LeadSource.name).where(LeadSource.id == lead_id))
     
-    if lead:
-        await state.update_data(target_lead_id=lead_id, target_name=lead.name)
+    if lead_name:
+        await state.update_data(target_lead_id=lead_id, target_name=lead_name)
         await callback.message.answer(
-            f"✅ <b>Выбран сегмент:</b> <code>{lead.name}</code>\n\n"
+            f"✅ <b>Выбран сегмент:</b> <code>{lead_name}</code>\n\n"
             "📢 <b>Выберите тип рассылки:</b>",
-            reply_markup=AdminKeyboards.broadcast_type_menu()  
+            reply_markup=BROADCAST_TYPE_KB
         )
     await state.set_state(AdminState.add_broadcast_type)
     await callback.answer()
@@ -550,41 +625,26 @@ async def create_broadcast_all(callback: CallbackQuery, state: FSMContext):
     await callback.message.answer(
         "✅ <b>Аудитория:</b> Всем пользователям\n\n"
         "📢 <b>Выберите тип рассылки:</b>",
-        reply_markup=AdminKeyboards.broadcast_type_menu()  
+        reply_markup=BROADCAST_TYPE_KB
     )
     await state.set_state(AdminState.add_broadcast_type)
     await callback.answer()
 
 
-@admin_router.callback_query(AdminState.add_broadcast_type, F.data == "broadcast_text")
-async def broadcast_text_start(callback: CallbackQuery, state: FSMContext):
-    """Текст → ввод текста."""
-    await callback.message.answer("📝 <b>Введите текст рассылки:</b>")
-    await state.set_state(AdminState.add_broadcast_text)
-    await callback.answer()
-
-
-@admin_router.callback_query(AdminState.add_broadcast_type, F.data == "broadcast_image")
-async def broadcast_image_start(callback: CallbackQuery, state: FSMContext):
-    """Картинка → отправка фото."""
-    await callback.message.answer("🖼️ <b>Отправьте картинку:</b>")
-    await state.set_state(AdminState.add_broadcast_image)
-    await callback.answer()
+BROADCAST_TYPE_PROMPTS = {
+    "broadcast_text": ("📝 <b>Введите текст рассылки:</b>", AdminState.add_broadcast_text),
+    "broadcast_image": ("🖼️ <b>Отправьте картинку:</b>", AdminState.add_broadcast_image),
+    "broadcast_file": ("📎 <b>Отправьте файл:</b>", AdminState.add_broadcast_file),
+    "broadcast_video": (VIDEO_PROMPT, AdminState.add_broadcast_video),
+}
 
 
-@admin_router.callback_query(AdminState.add_broadcast_type, F.data == "broadcast_file")
-async def broadcast_file_start(callback: CallbackQuery, state: FSMContext):
-    """Файл → отправка файла."""
-    await callback.message.answer("📎 <b>Отправьте файл:</b>")
-    await state.set_state(AdminState.add_broadcast_file)
-    await callback.answer()
-
-
-@admin_router.callback_query(AdminState.add_broadcast_type, F.data == "broadcast_video")
-async def broadcast_video_start(callback: CallbackQuery, state: FSMContext):
-    """Видео → отправка видео."""
-    await callback.message.answer("🎥 <b>Отправьте видео:</b>\n\n<i>Макс. 50 МБ, форматы: MP4</i>")
-    await state.set_state(AdminState.add_broadcast_video)  
+@admin_router.callback_query(AdminState.add_broadcast_type, F.data.in_(BROADCAST_TYPE_PROMPTS.keys()))
+async def broadcast_type_start(callback: CallbackQuery, state: FSMContext):
+    """Тип рассылки → запрос контента."""
+    prompt, next_state = BROADCAST_TYPE_PROMPTS[callback.data]
+    await callback.message.answer(prompt)
+    await state.set_state(next_state)
     await callback.answer()
 
 
@@ -650,6 +710,10 @@ async def create_broadcast_video(message: Message, state: FSMContext):
         await message.answer("❌ Отправьте видео!")
         return
     
+    if error := _video_error(message.video):
+        await message.answer(error)
+        return
+    
     file_id = message.video.file_id
     await state.update_data(
         file_id=file_id,
@@ -666,6 +730,15 @@ async def create_broadcast_video(message: Message, state: FSMContext):
     await state.set_state(AdminState.add_broadcast_time)
 
 
+_BROADCAST_CREATED_TMPL = Template(
+    "✅ <b>Рассылка создана #$id</b>\n\n"
+    "📢 <b>Тип:</b> $ctype\n"
+    "👥 <b>Кому:</b> $target\n"
+    "$status\n"
+    "🆔 <code>$id</code>"
+)
+
+
 @admin_router.message(AdminState.add_broadcast_time)
 async def create_broadcast_time(message: Message, state: FSMContext, session: AsyncSession):
     """Завершение рассылки."""
@@ -682,7 +755,7 @@ async def create_broadcast_time(message: Message, state: FSMContext, session: As
     
     broadcast = await add_broadcast(
         session,
-        title=f"Рассылка {datetime.now().strftime('%d.%m.%Y')}",
+        title=f"Рассылка {_fmt_now('%d.%m.%Y')}",
         content=data.get('content', ''),
         file_id=data.get('file_id'),
         file_type=data.get('content_type'),
@@ -691,9 +764,8 @@ async def create_broadcast_time(message: Message, state: FSMContext, session: As
     )
     
     if not scheduled_at:
-        await send_broadcast_now(session, message.bot, broadcast.id)
-        await session.refresh(broadcast)
-        status = f"🚀 <b>ОТПРАВЛЕНО</b> ({broadcast.sent_count} пользователей)"
+        send_broadcast_in_background(async_session_maker, message.bot, broadcast.id)
+        status = "🚀 <b>Отправка запущена</b>"
     else:
         status = "⏰ Запланировано"
     
@@ -708,11 +780,9 @@ async def create_broadcast_time(message: Message, state: FSMContext, session: As
     }
     
     await message.answer(
-        f"✅ <b>Рассылка создана #{broadcast.id}</b>\n\n"
-        f"📢 <b>Тип:</b> {type_names[content_type]}\n"
-        f"👥 <b>Кому:</b> {lead_name}\n"
-        f"{status}\n"
-        f"🆔 <code>{broadcast.id}</code>",
+        _BROADCAST_CREATED_TMPL.substitute(
+            id=broadcast.id, ctype=type_names[content_type], target=lead_name, status=status
+        ),
         reply_markup=ADMIN_MAIN_KB,
         parse_mode="HTML"
     )
@@ -735,57 +805,75 @@ async def users_menu(message: Message, session: AsyncSession, state: FSMContext)
     """Меню просмотра пользователей."""
     await state.set_state(AdminState.user_menu)
     
-    all_users = await get_all_users(session)
+    users_count = await get_user_count(session)
     text = f"👥 <b>Пользователи системы</b>\n\n"
-    text += f"<b>Всего пользователей:</b> <code>{len(all_users)}</code>\n\n"
+    text += f"<b>Всего пользователей:</b> <code>{users_count}</code>\n\n"
     text += "Выберите фильтр:"
     
     await message.answer(text, reply_markup=USERS_MENU_KB, parse_mode="HTML")
 
 
-@admin_router.callback_query(F.data == "users_all")
-async def show_all_users(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
-    """Показать всех пользователей с пагинацией."""
-    users = await get_all_users(session)
-    if not users:
-        await callback.message.answer("📭 Пользователи не найдены")
-        await callback.answer()
-        return
-    
-    page = 1
-    per_page = 10
-    total_pages = (len(users) + per_page - 1) // per_page
-    paginated_users = users[(page - 1) * per_page:page * per_page]
+_ALL_USERS_ROW = "{i}. <code>{uid}</code>\n   {fn} {ln}\n   Источник: <b>{src}</b>\n   Дата: {dt}\n\n"
+
+
+def _all_users_page(users: list[User], total: int, page: int, per_page: int = 10) -> tuple[str, InlineKeyboardMarkup]:
+    """Текст и клавиатура одной страницы списка всех пользователей."""
+    total_pages = (total + per_page - 1) // per_page
     
-    text = "👥 <b>Все пользователи</b>\n\n"
-    for i, user in enumerate(paginated_users, 1):
-        lead_name = user.lead_source.name if user.lead_source else "Не указан"
-        text += f"{i}. <code>{user.user_id}</code>\n"
-        text += f"   {user.first_name or ''} {user.last_name or ''}\n"
-        text += f"   Источник: <b>{lead_name}</b>\n"
-        text += f"   Дата: {user.registered_at.strftime('%d.%m.%Y %H:%M')}\n\n"
+    parts = ["👥 <b>Все пользователи</b>\n\n"]
+    for i, user in enumerate(users, (page - 1) * per_page + 1):
+        parts.append(_ALL_USERS_ROW.format(
+            i=i,
+            uid=user.user_id,
+            fn=user.first_name or "",
+            ln=user.last_name or "",
+            src=user.lead_source.name if user.lead_source else "Не указан",
+            dt=_fmt_dt(user.registered_at),
+        ))
+    text = "".join(parts)
     
     builder = InlineKeyboardBuilder()
     
-    nav_row = []
     if page > 1:
-        builder.button(text="◀️", callback_data=f"users_page_{page-1}")
+        builder.button(text="◀️", callback_data=f"all_users_page_{page-1}")
     builder.button(text=f"{page}/{total_pages}", callback_data="empty")
     if page < total_pages:
-        builder.button(text="▶️", callback_data=f"users_page_{page+1}")
+        builder.button(text="▶️", callback_data=f"all_users_page_{page+1}")
     builder.adjust(3)
     
     builder.button(text="🔙 Назад", callback_data="admin_main")
+    return text, builder.as_markup()
+
+
+@admin_router.callback_query(F.data == "users_all")
+async def show_all_users(callback: CallbackQuery, session: AsyncSession):
+    """Показать всех пользователей с пагинацией (страница читается из БД через LIMIT/OFFSET)."""
+    users, total = await get_all_users_paginated(session, page=1)
+    if not users:
+        await callback.message.answer("📭 Пользователи не найдены")
+        await callback.answer()
+        return
     
-    await state.set_state(AdminState.message_users_page)  
+    text, kb = _all_users_page(users, total, page=1)
     await callback.message.answer(
         text, 
-        reply_markup=builder.as_markup(), 
+        reply_markup=kb, 
         parse_mode="HTML"
     )
     await callback.answer()
 
 
+@admin_router.callback_query(F.data.startswith("all_users_page_"))
+async def all_users_pagination(callback: CallbackQuery, session: AsyncSession):
+    """Переход по страницам списка всех пользователей."""
+    page = int(callback.data.removeprefix("all_users_page_"))
+    users, total = await get_all_users_paginated(session, page)
+    
+    text, kb = _all_users_page(users, total, page)
+    await _edit_or_answer(callback, text, kb)
+    await callback.answer()
+
+
 @admin_router.callback_query(F.data == "users_by_lead")
 async def users_by_lead_menu(callback: CallbackQuery, session: AsyncSession):
     """Выбор источника лидов для фильтрации пользователей."""
@@ -796,23 +884,27 @@ async def users_by_lead_menu(callback: CallbackQuery, session: AsyncSession):
     
     inline_keyboard = []
     for lead in leads:
-        inline_keyboard.append([InlineKeyboardButton(text=lead.name, callback_data=f"filter_users_{lead.id}")])
+        inline_keyboard.append([InlineKeyboardButton(text=lead.name, callback_data=LeadCb(action="filter", id=lead.id).pack())])
     inline_keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_main")])
     
     kb = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
     
-    await callback.message.answer(
-        "📋 <b>Выберите источник лидов:</b>",
-        reply_markup=kb,
-        parse_mode="HTML"
-    )
+    await _edit_or_answer(callback, "📋 <b>Выберите источник лидов:</b>", kb)
     await callback.answer()
 
 
-@admin_router.callback_query(F.data.startswith("filter_users_"))
-async def filter_users_by_lead(callback: CallbackQuery, session: AsyncSession):
+_LEAD_USER_ROW = "🆔 {uid} — {username}\n👤 {fn} {ln}\n📱 {phone}\n📅 {dt}\n────────────"
+
+FILTERED_USERS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_main")],
+    [InlineKeyboardButton(text="🏠 В меню", callback_data="admin_main")]
+])
+
+
+@admin_router.callback_query(LeadCb.filter(F.action == "filter"), flags={"throttle": "filter_users"})
+async def filter_users_by_lead(callback: CallbackQuery, callback_data: LeadCb, session: AsyncSession):
     """Выводит список пользователей, относящихся к выбранному источнику лида."""
-    lead_id = int(callback.data.split("_")[-1])
+    lead_id = callback_data.id
     
 
     lead_source = await session.get(LeadSource, lead_id)
@@ -821,7 +913,17 @@ async def filter_users_by_lead(callback: CallbackQuery, session: AsyncSession):
         return
     
 
-    users = await get_users_by_lead_source(session, lead_id)
+    # Повторный клик в пределах rate гасит ThrottlingMiddleware (флаг throttle). Клик позже,
+    # пока выборка ещё идёт, ждёт её же и не шлёт второй список. Выборка в своей сессии:
+    # её результат (Row) не зависит от сессии хендлера, который её запустил
+    async def _fetch_users():
+        async with async_session_maker() as fetch_session:
+            return await get_users_by_lead_source(fetch_session, lead_id)
+
+    users, shared = await single_flight(("filter_users", callback.from_user.id, lead_id), _fetch_users)
+    if shared:
+        await callback.answer()
+        return
     
     if not users:
         await callback.message.answer(f"👤 Пользователи для источника <b>{lead_source.name}</b> не найдены.", parse_mode="HTML")
@@ -830,23 +932,18 @@ async def filter_users_by_lead(callback: CallbackQuery, session: AsyncSession):
 
     text_lines = [f"<b>Пользователи из источника:</b> {lead_source.name}\n"]
     for user in users:
-        username = f"@{user.username}" if user.username else "(без username)"
-        text_lines.append(
-            f"🆔 {user.user_id} — {username}\n"
-            f"👤 {user.first_name or ''} {user.last_name or ''}\n"
-            f"📱 {user.phone or '—'}\n"
-            f"📅 {user.registered_at.strftime('%d.%m.%Y %H:%M') if user.registered_at else '—'}"
-        )
-        text_lines.append("────────────")
+        text_lines.append(_LEAD_USER_ROW.format(
+            uid=user.user_id,
+            username=f"@{user.username}" if user.username else "(без username)",
+            fn=user.first_name or "",
+            ln=user.last_name or "",
+            phone=user.phone or "—",
+            dt=_fmt_dt(user.registered_at) if user.registered_at else "—",
+        ))
 
     text = "\n".join(text_lines)
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_main")],
-        [InlineKeyboardButton(text="🏠 В меню", callback_data="admin_main")]
-    ])
-    
-    await callback.message.answer(text, parse_mode='HTML', reply_markup=kb)
+    await _edit_or_answer(callback, text, FILTERED_USERS_KB)
     await callback.answer()
 # =============================================================================
 # ГЛОБАЛЬНЫЕ ОБРАБОТЧИКИ FSM — БЕЗ StateFilter
@@ -864,7 +961,8 @@ async def cancel_admin_action(message: Message, state: FSMContext):
 @admin_router.callback_query(F.data == "admin_main")
 async def back_to_admin_main(callback: CallbackQuery, state: FSMContext):
     """Возврат в главное меню админки."""
-    await state.clear()
+    if await state.get_state():
+        await state.clear()
     await callback.message.answer(
         "🔐 <b>Административная панель</b>",
         reply_markup=ADMIN_MAIN_KB,
@@ -894,76 +992,93 @@ async def delete_lead_menu(callback: CallbackQuery, session: AsyncSession, state
     
     inline_keyboard = []
     for lead in leads:
-        inline_keyboard.append([InlineKeyboardButton(text=f"🗑 {lead.name}", callback_data=f"delete_lead_{lead.id}")])
+        inline_keyboard.append([InlineKeyboardButton(text=f"🗑 {lead.name}", callback_data=LeadCb(action="delete", id=lead.id).pack())])
     inline_keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_main")])
     
     kb = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
     
-    await callback.message.answer("🗑 Выберите источник для удаления:", reply_markup=kb)
+    await _edit_or_answer(callback, "🗑 Выберите источник для удаления:", kb, parse_mode=None)
     await state.set_state(AdminState.delete_lead_source_select)
     await callback.answer()
 
 
 
-@admin_router.callback_query(F.data.startswith("delete_lead_"))
-async def delete_lead_source_confirm(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
-    """Подтверждение удаления источника лидов."""
-    lead_id = int(callback.data.split("_")[-1])
+@lru_cache(maxsize=256)
+def _confirm_delete_kb(lead_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Удалить", callback_data=LeadCb(action="confirm", id=lead_id).pack())],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_main")]
+    ])
 
-    result = await session.execute(
-        select(LeadSource)
-        .options(selectinload(LeadSource.users))
-        .where(LeadSource.id == lead_id)
-    )
-    lead = result.scalar_one_or_none()
 
+@admin_router.callback_query(LeadCb.filter(F.action == "delete"))
+async def delete_lead_source_confirm(callback: CallbackQuery, callback_data: LeadCb, session: AsyncSession, state: FSMContext):
+    """Подтверждение удаления источника лидов."""
+    lead_id = callback_data.id
+
+    lead = await session.get(LeadSource, lead_id)
     if not lead:
         await callback.answer("❌ Источник не найден")
         return
 
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Удалить", callback_data=f"confirm_delete_lead_{lead_id}")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_main")]
-    ])
+    kb = _confirm_delete_kb(lead_id)
 
-    users_count = len(lead.users) if lead.users else 0
+    # Считаем пользователей в БД, не загружая связь целиком
+    users_count = await session.scalar(
+        select(func.count(User.id)).where(User.lead_source_id == lead_id)
+    )
 
-    await callback.message.answer(
+    await _edit_or_answer(
+        callback,
         f"⚠️ <b>Удалить источник лидов?</b>\n\n"
         f"<b>{lead.name}</b>\n"
         f"{lead.description or ''}\n\n"
         f"Пользователей: <code>{users_count}</code>",
-        reply_markup=kb,
-        parse_mode="HTML"
+        kb
     )
     await callback.answer()
 
 
-@admin_router.callback_query(F.data.startswith("confirm_delete_lead_"))
-async def delete_lead_source_exec(callback: CallbackQuery, session: AsyncSession):
+@admin_router.callback_query(LeadCb.filter(F.action == "confirm"), flags={"throttle": "delete_lead"})
+async def delete_lead_source_exec(callback: CallbackQuery, callback_data: LeadCb, session: AsyncSession):
     """Выполнение удаления источника лидов."""
-    lead_id = int(callback.data.split("_")[-1])
+    lead_id = callback_data.id
     await delete_lead_source(session, lead_id)
     
     await callback.message.answer("✅ Источник лидов удалён")
     await callback.answer("Удалено")
     
 
+EDIT_TEXTS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Этап 1: Вебинар", callback_data="edit_stage1")],
+    [InlineKeyboardButton(text="Этап 2: Челлендж", callback_data="edit_stage2")],
+    [InlineKeyboardButton(text="Этап 3: Урок + Отзыв", callback_data="edit_stage3")],
+    [InlineKeyboardButton(text="Назад", callback_data="admin_main")]
+])
+
+
 @admin_router.message(F.text == "🛠 Изменить тексты")
 async def edit_texts_menu(message: Message, state: FSMContext):
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Этап 1: Вебинар", callback_data="edit_stage1")],
-        [InlineKeyboardButton(text="Этап 2: Челлендж", callback_data="edit_stage2")],
-        [InlineKeyboardButton(text="Этап 3: Урок + Отзыв", callback_data="edit_stage3")],
-        [InlineKeyboardButton(text="Назад", callback_data="admin_main")]
-    ])
-    await message.answer("Выберите:", reply_markup=kb)
+    await message.answer("Выберите:", reply_markup=EDIT_TEXTS_KB)
     await state.set_state(AdminState.edit_stage_select)
 
 
+@lru_cache(maxsize=16)
+def _edit_stage_kb(stage: str, with_feedback: bool) -> InlineKeyboardMarkup:
+    """Клавиатура этапа собирается целиком здесь — закэшированный объект не меняем."""
+    rows = [
+        [InlineKeyboardButton(text="Приветствие", callback_data=EditTextCb(field="welcome_text", stage=stage).pack())],
+        [InlineKeyboardButton(text="Текст меню", callback_data=EditTextCb(field="main_menu_text", stage=stage).pack())],
+    ]
+    if with_feedback:
+        rows.append([InlineKeyboardButton(text="Варианты отзыва", callback_data="edit_feedback")])
+    rows.append([InlineKeyboardButton(text="Назад", callback_data="admin_main")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
 @admin_router.callback_query(F.data.startswith("edit_stage"))
 async def edit_stage(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
-    stage = callback.data.split("edit_")[-1]
+    stage = callback.data.removeprefix("edit_")
     st = await get_stage_text(session, stage)
     fb = await get_feedback_options(session) if stage == "stage3" else None
 
@@ -973,22 +1088,13 @@ async def edit_stage(callback: CallbackQuery, session: AsyncSession, state: FSMC
     if fb:
         text += f"\n<b>Варианты отзыва:</b>\n1. {fb.option_1}\n2. {fb.option_2}\n3. {fb.option_3}"
 
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Приветствие", callback_data=f"edit_welcome_{stage}")],
-        [InlineKeyboardButton(text="Текст меню", callback_data=f"edit_menu_{stage}")],
-    ])
-    if fb:
-        kb.inline_keyboard.append([InlineKeyboardButton(text="Варианты отзыва", callback_data="edit_feedback")])
-    kb.inline_keyboard.append([InlineKeyboardButton(text="Назад", callback_data="admin_main")])
-
-    await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    await _edit_or_answer(callback, text, _edit_stage_kb(stage, with_feedback=fb is not None))
     await state.update_data(edit_stage=stage)
 
 
-@admin_router.callback_query(F.data.startswith("edit_welcome_") | F.data.startswith("edit_menu_"))
-async def edit_field(callback: CallbackQuery, state: FSMContext):
-    field = "welcome_text" if "welcome" in callback.data else "main_menu_text"
-    stage = callback.data.split("_")[-1]
+@admin_router.callback_query(EditTextCb.filter())
+async def edit_field(callback: CallbackQuery, callback_data: EditTextCb, state: FSMContext):
+    field, stage = callback_data.field, callback_data.stage
     await state.update_data(edit_field=field, edit_stage=stage)
     await callback.message.answer(
         f"Новый текст для <b>{'приветствия' if field == 'welcome_text' else 'меню'}</b>:",
@@ -11,7 +11,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database.models import User, MessageSchedule
 from app.database.crud_user import get_user_by_id
-from app.database.crud_admin import add_message_schedule
+from app.database.crud_admin import add_message_schedules_bulk
 from app.kbds.kbds import InlineKeyboards, ReplyKeyboards
 
 logger = logging.getLogger(__name__)
@@ -20,21 +20,42 @@ challenge_router = Router()
 # =============================================================================
 # ДАТЫ ЧЕЛЛЕНДЖА
 # =============================================================================
+ALMATY_TZ = ZoneInfo("Asia/Almaty")
+
 CHALLENGE_DATES = {
-    "day2_morning": datetime(2025, 11, 11, 10, 0, tzinfo=ZoneInfo("Asia/Almaty")),
-    "day2_afternoon": datetime(2025, 11, 11, 13, 0, tzinfo=ZoneInfo("Asia/Almaty")),
-    "day3_morning": datetime(2025, 11, 12, 10, 0, tzinfo=ZoneInfo("Asia/Almaty")),
-    "day3_afternoon": datetime(2025, 11, 12, 13, 0, tzinfo=ZoneInfo("Asia/Almaty")),
-    "final": datetime(2025, 11, 13, 13, 0, tzinfo=ZoneInfo("Asia/Almaty")),
+    "day2_morning": datetime(2025, 11, 11, 10, 0, tzinfo=ALMATY_TZ),
+    "day2_afternoon": datetime(2025, 11, 11, 13, 0, tzinfo=ALMATY_TZ),
+    "day3_morning": datetime(2025, 11, 12, 10, 0, tzinfo=ALMATY_TZ),
+    "day3_afternoon": datetime(2025, 11, 12, 13, 0, tzinfo=ALMATY_TZ),
+    "final": datetime(2025, 11, 13, 13, 0, tzinfo=ALMATY_TZ),
 }
 
-REGISTRATION_START = datetime(2025, 11, 7, 0, 0, tzinfo=ZoneInfo("Asia/Almaty"))
+# send_time в message_schedule хранится naive (время Алматы)
+CHALLENGE_SEND_TIMES = [dt.replace(tzinfo=None) for dt in CHALLENGE_DATES.values()]
+
+# Сколько пользователей планируем за один SELECT + INSERT при массовом восстановлении
+SCHEDULE_CHUNK_SIZE = 1000
+
+REGISTRATION_START = datetime(2025, 11, 7, 0, 0, tzinfo=ALMATY_TZ)
 COURSE_LINK = "https://www.nutrikaz.kz/#rec1462578793"
 CHAT_LINK = "https://t.me/nutrikaz"
 
 # =============================================================================
 # СООБЩЕНИЯ
 # =============================================================================
+# Ответ на регистрацию (меню и кнопка челленджа)
+CHALLENGE_WELCOME_TEXT = (
+    "🎉 <b>Добро пожаловать в мини-челлендж «Наука тела»!</b>\n\n"
+    "🍎 3 дня для тебя и твоего тела\n"
+    "📅 10–12 ноября\n\n"
+    "💡 Что вас ждёт:\n"
+    "• Простые рецепты на каждый день\n"
+    "• Питание без подсчёта калорий\n"
+    "• Результаты уже через 3 дня\n\n"
+    "👥 Присоединяйтесь к чату участников — там мы делимся рецептами и поддерживаем друг друга!\n\n"
+    "⏰ <b>Старт — 10 ноября, 9:00</b>"
+)
+
 MESSAGES = {
     "day2_morning": (
         "🍫 День 2. «Ем, не наказываю»\n\n"
@@ -99,36 +120,54 @@ MESSAGES = {
 # =============================================================================
 # ФУНКЦИЯ: планирование сообщений 
 # =============================================================================
-async def register_challenge(session: AsyncSession, user: User):
-    """Планирует все сообщения челленджа. Дубли не создаются."""
-    try:
-        for key, scheduled_dt in CHALLENGE_DATES.items():
-            send_time_naive = scheduled_dt.replace(tzinfo=None)
-
-            exists = await session.execute(
-                select(MessageSchedule).where(
-                    MessageSchedule.user_id == user.id,
-                    MessageSchedule.send_time == send_time_naive
-                )
-            )
-            if exists.scalar_one_or_none():
-                logger.info(f"Сообщение на {scheduled_dt} уже запланировано для {user.user_id}, пропускаем")
-                continue
-
-            await add_message_schedule(
-                session=session,
-                user_id=user.id,
-                message_text=MESSAGES[key],
-                scheduled_at=scheduled_dt  
+def compute_challenge_schedules(user_id: int) -> list[dict]:
+    """Строки message_schedule всех сообщений челленджа для user.id — без обращений к БД."""
+    return [
+        {
+            "user_id": user_id,
+            "message_text": MESSAGES[key],
+            "send_time": scheduled_dt.replace(tzinfo=None),
+            "sent": False,
+        }
+        for key, scheduled_dt in CHALLENGE_DATES.items()
+    ]
+
+
+async def schedule_challenge_for_users(session: AsyncSession, user_ids: list[int]) -> int:
+    """
+    Планирует челлендж для списка user.id кусками по SCHEDULE_CHUNK_SIZE:
+    на кусок — один SELECT уже запланированного и один INSERT (executemany).
+    Дубли не создаются. Коммит — на вызывающей стороне. Возвращает число новых сообщений.
+    """
+    added = 0
+    for i in range(0, len(user_ids), SCHEDULE_CHUNK_SIZE):
+        chunk = user_ids[i:i + SCHEDULE_CHUNK_SIZE]
+        result = await session.execute(
+            select(MessageSchedule.user_id, MessageSchedule.send_time).where(
+                MessageSchedule.user_id.in_(chunk),
+                MessageSchedule.send_time.in_(CHALLENGE_SEND_TIMES)
             )
-            logger.info(f"Запланировано сообщение '{key}' на {scheduled_dt} для {user.user_id}")
+        )
+        existing = {tuple(row) for row in result}
 
-        await session.commit()
-        logger.info(f"ВСЕ сообщения челленджа успешно запланированы для {user.user_id}")
+        rows = [
+            row
+            for user_id in chunk
+            for row in compute_challenge_schedules(user_id)
+            if (row["user_id"], row["send_time"]) not in existing
+        ]
+        await add_message_schedules_bulk(session, rows, commit=False)
+        added += len(rows)
+    return added
 
-    except Exception as e:
-        await session.rollback()
-        logger.error(f"Ошибка при планировании челленджа для {user.user_id}: {e}", exc_info=True)
+
+async def register_challenge(session: AsyncSession, user: User):
+    """
+    Планирует все сообщения челленджа. Дубли не создаются.
+    Коммит и откат при ошибке — на вызывающей стороне.
+    """
+    added = await schedule_challenge_for_users(session, [user.id])
+    logger.info("Челлендж запланирован для %s: новых сообщений %s", user.user_id, added)
 
 
 # =============================================================================
@@ -141,7 +180,7 @@ async def challenge_registration(callback: CallbackQuery, session: AsyncSession,
         await callback.answer("Ошибка: пользователь не найден.", show_alert=True)
         return
 
-    now = datetime.now(ZoneInfo("Asia/Almaty"))
+    now = datetime.now(ALMATY_TZ)
 
     if now < REGISTRATION_START:
         await callback.message.answer(
@@ -153,15 +192,22 @@ async def challenge_registration(callback: CallbackQuery, session: AsyncSession,
         await callback.answer()
         return
 
+    try:
+        await register_challenge(session, user)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        logger.exception("Ошибка при планировании челленджа для %s", user.user_id)
+        await callback.answer("Ошибка. Попробуйте позже.", show_alert=True)
+        return
+
     await callback.message.answer(
-        MESSAGES["day1_morning"],
+        CHALLENGE_WELCOME_TEXT,
         parse_mode="HTML",
         disable_web_page_preview=True,
         reply_markup=InlineKeyboards.challenge_menu()
     )
 
-    await register_challenge(session, user)
-
     await callback.answer("Вы успешно зарегистрированы на челлендж!")
 
 
@@ -1,6 +1,8 @@
 import logging
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
+from typing import Optional
 from zoneinfo import ZoneInfo
 
 from aiogram import F, Router
@@ -10,50 +12,84 @@ from aiogram.fsm.context import FSMContext
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.database.crud_user import add_user, get_user_by_id
+from app.database.crud_user import add_user, get_user_by_id, user_count_cache
 from app.database.crud_admin import (
-    get_lead_source_by_name,
+    get_lead_source_id_by_name,
     assign_user_to_lead_source,
     get_stage_text
 )
 
 # Импорт функций для обработки воронок
 from app.handlers.webinar import RECORD_LINK, WEBINAR_DATETIME, WEBINAR_TEXTS, schedule_webinar_reminders
-from app.handlers.challenge import register_challenge
+from app.handlers.challenge import register_challenge, CHALLENGE_WELCOME_TEXT
 from app.handlers.lead_magnet import schedule_lead_magnet_messages
 
 from app.kbds.kbds import InlineKeyboards, ReplyKeyboards
+from app.middlewares.throttling import ThrottlingMiddleware
 
 # =============================================================================
 # НАСТРОЙКИ
 # =============================================================================
 logger = logging.getLogger(__name__)
 common_router = Router()
+common_router.callback_query.middleware(ThrottlingMiddleware())
 ALMATY_TZ = ZoneInfo("Asia/Almaty")
 
+# Баннер главного меню: наличие файла проверяем один раз при старте
+BANNER_PATH = Path("media/main_banner.jpg")
+BANNER_EXISTS = BANNER_PATH.exists()
+
+# file_id баннера главного меню после первой загрузки
+_banner_file_id: Optional[str] = None
+
+# Статичные клавиатуры собираем один раз при импорте
+BACK_TO_MENU_KB = ReplyKeyboards.back_to_menu()
+CHALLENGE_WELCOME_KB = InlineKeyboards.challenge_menu()
+# Меню по этапам; None — вне дат воронок (только «Купить курс» и «Главное меню»)
+MAIN_MENU_KB_BY_STAGE = {stage: InlineKeyboards.main_menu(stage) for stage in ("stage1", "stage2", "stage3", None)}
+
 # =============================================================================
 # ОПРЕДЕЛЕНИЕ ТЕКУЩЕГО ЭТАПА ПО РЕАЛЬНЫМ ДАТАМ
 # =============================================================================
-def get_current_stage() -> str:
+# Окна этапов в Unix-времени: на каждом апдейте сравниваем числа, без datetime.
+# stage1: с 29 октября до 7 ноября (до начала stage2)
+# stage2: 7–12 ноября
+# stage3: 14–17 ноября
+_STAGE_WINDOWS = tuple(
+    (
+        datetime(*start, tzinfo=ALMATY_TZ).timestamp(),
+        datetime(*end, tzinfo=ALMATY_TZ).timestamp(),
+        stage,
+    )
+    for start, end, stage in (
+        ((2025, 10, 29), (2025, 11, 7), "stage1"),
+        ((2025, 11, 7), (2025, 11, 13), "stage2"),
+        ((2025, 11, 14), (2025, 11, 18), "stage3"),
+    )
+)
+_STAGE_BOUNDARIES = sorted({ts for start, end, _ in _STAGE_WINDOWS for ts in (start, end)})
+
+# (действует до, этап) — результат переиспользуется до минуты или до ближайшей границы этапа
+_stage_cache: tuple[float, Optional[str]] = (0.0, None)
+
+
+def get_current_stage() -> Optional[str]:
     """
     ДАТЫ ПО ТЗ:
     - stage1: с 29 октября → вебинар (6 ноября)
     - stage2: 7–10 ноября → мини-челлендж
     - stage3: 14–17 ноября → бесплатный урок
     """
-    now = datetime.now(ALMATY_TZ)
-
-    # stage1: с 29 октября до 7 ноября (до начала stage2)
-    if datetime(2025, 10, 29, 0, 0, tzinfo=ALMATY_TZ) <= now < datetime(2025, 11, 7, 0, 0, tzinfo=ALMATY_TZ):
-        return "stage1"
+    global _stage_cache
+    now = time.time()
+    cached_until, stage = _stage_cache
+    if now < cached_until:
+        return stage
 
-    # stage2: 7–12 ноября
-    elif datetime(2025, 11, 7, 0, 0, tzinfo=ALMATY_TZ) <= now < datetime(2025, 11, 13, 0, 0, tzinfo=ALMATY_TZ):
-        return "stage2"
-
-    # stage3: 14–17 ноября
-    elif datetime(2025, 11, 14, 0, 0, tzinfo=ALMATY_TZ) <= now < datetime(2025, 11, 18, 0, 0, tzinfo=ALMATY_TZ):
-        return "stage3"
+    stage = next((name for start, end, name in _STAGE_WINDOWS if start <= now < end), None)
+    next_boundary = next((ts for ts in _STAGE_BOUNDARIES if ts > now), float("inf"))
+    _stage_cache = (min(now + 60, next_boundary), stage)
+    return stage
 
 
 # =============================================================================
@@ -68,8 +104,8 @@ async def cmd_start(message: Message, session: AsyncSession, state: FSMContext):
     """
     try:
         # Парсинг deep link
-        args = message.text.split()[1:] if len(message.text.split()) > 1 else []
-        lead_source_name = args[0].lower() if args else None
+        args = message.text.split(maxsplit=2)
+        lead_source_name = args[1].lower() if len(args) > 1 else None
         
         # Валидация источника
         valid_sources = ["webinar", "lead_magnet", "challenge"]
@@ -94,13 +130,13 @@ async def cmd_start(message: Message, session: AsyncSession, state: FSMContext):
         # Показываем главное меню
         await _show_main_menu_by_stage(message, session)
         
-        logger.info(f"Пользователь {user.user_id} открыл главное меню")
+        logger.info("Пользователь %s открыл главное меню", user.user_id)
         
     except Exception as e:
-        logger.error(f"Ошибка в cmd_start: {e}")
+        logger.exception("Ошибка в cmd_start")
         await message.answer(
             "Ошибка регистрации. Попробуйте /start еще раз.",
-            reply_markup=ReplyKeyboards.back_to_menu()
+            reply_markup=BACK_TO_MENU_KB
         )
 
 
@@ -117,13 +153,26 @@ async def _handle_deep_link_flow(
     - Показывает приветствие
     - Запускает соответствующую рассылку
     """
-    lead_source = await get_lead_source_by_name(session, lead_source_name)
-    if not lead_source:
+    lead_source_id = await get_lead_source_id_by_name(session, lead_source_name)
+    if lead_source_id is None:
         await message.answer("Источник не найден")
         return
     
-    await assign_user_to_lead_source(session, user.user_id, lead_source_name)
-    await session.commit()
+    # Запуск воронки — в одной транзакции с привязкой к источнику
+    try:
+        await assign_user_to_lead_source(session, user.user_id, lead_source_name)
+        if lead_source_name == "webinar":
+            await schedule_webinar_reminders(session, user, state)
+        elif lead_source_name == "lead_magnet":
+            await schedule_lead_magnet_messages(session, user, state)
+        elif lead_source_name == "challenge":
+            await register_challenge(session, user)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        logger.exception("Ошибка запуска воронки %s: user %s", lead_source_name, user.user_id)
+        await message.answer("Ошибка. Попробуйте позже.", reply_markup=BACK_TO_MENU_KB)
+        return
     
     # Приветствие из БД
     stage_map = {"webinar": "stage1", "challenge": "stage2", "lead_magnet": "stage3"}
@@ -133,18 +182,10 @@ async def _handle_deep_link_flow(
     await message.answer(
         welcome_text,
         parse_mode="HTML",
-        reply_markup=ReplyKeyboards.back_to_menu()
+        reply_markup=BACK_TO_MENU_KB
     )
     
-    # Запуск воронки
-    if lead_source_name == "webinar":
-        await schedule_webinar_reminders(session, user, state)
-    elif lead_source_name == "lead_magnet":
-        await schedule_lead_magnet_messages(session, user, state)
-    elif lead_source_name == "challenge":
-        await register_challenge(session, user)
-    
-    logger.info(f"Пользователь {user.user_id} начал воронку {lead_source_name}")
+    logger.info("Пользователь %s начал воронку %s", user.user_id, lead_source_name)
 
 
 async def _show_main_menu_by_stage(message: Message, session: AsyncSession):
@@ -159,22 +200,30 @@ async def _show_main_menu_by_stage(message: Message, session: AsyncSession):
         await message.answer("Ошибка загрузки меню.")
         return
 
-    caption = stage_text.welcome_text
-    banner_path = Path("media/main_banner.jpg")
-    main_menu_inline = InlineKeyboards.main_menu(stage)
+    await _answer_with_banner(message, stage_text.welcome_text, MAIN_MENU_KB_BY_STAGE[stage])
+
 
-    if banner_path.exists():
-        await message.answer_photo(
-            photo=FSInputFile(banner_path),
+async def _answer_with_banner(message: Message, caption: str, reply_markup) -> None:
+    """
+    Отправляет меню с баннером. Файл загружается в Telegram один раз,
+    дальше баннер отправляется по сохранённому file_id.
+    """
+    global _banner_file_id
+
+    if BANNER_EXISTS:
+        sent = await message.answer_photo(
+            photo=_banner_file_id or FSInputFile(BANNER_PATH),
             caption=caption,
             parse_mode="HTML",
-            reply_markup=main_menu_inline
+            reply_markup=reply_markup
         )
+        if _banner_file_id is None and sent.photo:
+            _banner_file_id = sent.photo[-1].file_id
     else:
         await message.answer(
             caption,
             parse_mode="HTML",
-            reply_markup=main_menu_inline
+            reply_markup=reply_markup
         )
 
 
@@ -182,18 +231,23 @@ async def _show_main_menu_by_stage(message: Message, session: AsyncSession):
 # ОБРАБОТЧИКИ КНОПОК МЕНЮ
 # =============================================================================
 
-@common_router.callback_query(F.data == "want_participate")
+@common_router.callback_query(F.data == "want_participate", flags={"throttle": "webinar"})
 async def webinar_from_menu(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
     """Кнопка «Хочу на вебинар» — только на stage1"""
     user = await get_user_by_id(session, callback.from_user.id)
-    await assign_user_to_lead_source(session, user.user_id, "webinar")
-    await session.commit()
+    try:
+        await assign_user_to_lead_source(session, user.user_id, "webinar")
+        await schedule_webinar_reminders(session, user, state)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        logger.exception("Ошибка регистрации на вебинар: user %s", user.user_id)
+        await callback.answer("Ошибка. Попробуйте позже.", show_alert=True)
+        return
 
     now = datetime.now(ALMATY_TZ)
     after_webinar = now >= WEBINAR_DATETIME + timedelta(hours=1, minutes=30)
 
-    await schedule_webinar_reminders(session, user, state)
-
     await callback.message.answer(
         WEBINAR_TEXTS["welcome_after_reg"],
         parse_mode="HTML",
@@ -205,13 +259,20 @@ async def webinar_from_menu(callback: CallbackQuery, session: AsyncSession, stat
     await callback.answer("Зарегистрированы на вебинар!")
 
 
-@common_router.callback_query(F.data == "get_free_lesson")
+@common_router.callback_query(F.data == "get_free_lesson", flags={"throttle": "lead_magnet"})
 async def lead_magnet_from_menu(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
     """Кнопка «Бесплатный урок» — только на stage3"""
     user = await get_user_by_id(session, callback.from_user.id)
-    await assign_user_to_lead_source(session, user.user_id, "lead_magnet")
-    await session.commit()
-    
+    try:
+        await assign_user_to_lead_source(session, user.user_id, "lead_magnet")
+        await schedule_lead_magnet_messages(session, user, state)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        logger.exception("Ошибка планирования лид-магнита: user %s", user.user_id)
+        await callback.answer("Ошибка. Попробуйте позже.", show_alert=True)
+        return
+
     stage_text = await get_stage_text(session, "stage3")
     welcome_text = (
         stage_text.welcome_text 
@@ -219,12 +280,6 @@ async def lead_magnet_from_menu(callback: CallbackQuery, session: AsyncSession,
         else "Бесплатный урок активирован!\nПридёт через несколько минут"
     )
 
-    try:
-        await schedule_lead_magnet_messages(session, user, state)
-    except Exception as e:
-        logger.error(f"Ошибка планирования лид-магнита: {e}")
-        welcome_text = "Ошибка. Попробуйте позже."
-
     await callback.message.answer(
         welcome_text,
         parse_mode="HTML",
@@ -233,45 +288,41 @@ async def lead_magnet_from_menu(callback: CallbackQuery, session: AsyncSession,
     await callback.answer("Готово!")
 
 
-@common_router.callback_query(F.data == "join_challenge")
+@common_router.callback_query(F.data == "join_challenge", flags={"throttle": "challenge"})
 async def challenge_from_menu(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
     """Кнопка «Челлендж» — только на stage2"""
     user_id = callback.from_user.id
-    user = await get_user_by_id(session, user_id)
-    if not user:
-        user = await add_user(
-            session=session,
-            user_id=user_id,
-            username=callback.from_user.username,
-            first_name=callback.from_user.first_name,
-            last_name=callback.from_user.last_name,
-            lead_source_id=None
-        )
+    try:
+        user = await get_user_by_id(session, user_id)
+        created = user is None
+        if created:
+            user = await add_user(
+                session=session,
+                user_id=user_id,
+                username=callback.from_user.username,
+                first_name=callback.from_user.first_name,
+                last_name=callback.from_user.last_name,
+                lead_source_id=None,
+                commit=False
+            )
+
+        await assign_user_to_lead_source(session, user.user_id, "challenge")
+        await register_challenge(session, user)
         await session.commit()
-    else:
-        await session.refresh(user)
-
-    await assign_user_to_lead_source(session, user.user_id, "challenge")
-    await session.commit()
-
-    text = (
-        "🎉 <b>Добро пожаловать в мини-челлендж «Наука тела»!</b>\n\n"
-        "🍎 3 дня для тебя и твоего тела\n"
-        "📅 10–12 ноября\n\n"
-        "💡 Что вас ждёт:\n"
-        "• Простые рецепты на каждый день\n"
-        "• Питание без подсчёта калорий\n"
-        "• Результаты уже через 3 дня\n\n"
-        "👥 Присоединяйтесь к чату участников — там мы делимся рецептами и поддерживаем друг друга!\n\n"
-        "⏰ <b>Старт — 10 ноября, 9:00</b>"
-    )
+    except Exception:
+        await session.rollback()
+        logger.exception("Ошибка регистрации в челлендж: user %s", user_id)
+        await callback.answer("Ошибка. Попробуйте позже.", show_alert=True)
+        return
 
-    await register_challenge(session, user)
+    # add_user(commit=False) кэш не трогает — новый пользователь виден в счётчике после коммита
+    if created:
+        user_count_cache.clear()
 
     await callback.message.answer(
-        text,
+        CHALLENGE_WELCOME_TEXT,
         parse_mode="HTML",
-        reply_markup=InlineKeyboards.challenge_menu()
+        reply_markup=CHALLENGE_WELCOME_KB
     )
     await callback.answer("Вы зарегистрированы на мини-челлендж!")
 
@@ -280,10 +331,7 @@ async def challenge_from_menu(callback: CallbackQuery, session: AsyncSession, st
 # ЕДИНЫЙ ОФФЕР — КУПИТЬ КУРС
 # =============================================================================
 
-@common_router.callback_query(F.data == "buy_course")
-async def handle_buy_course(callback: CallbackQuery):
-    """Единый оффер — покупка курса (доступен на всех этапах)"""
-    course_info = (
+COURSE_INFO_TEXT = (
     "🎓 <b>ЕДИНЫЙ ОФФЕР — КУРС «НАУКА ТЕЛА»</b>\n\n"
     "🌿 <i>Системное похудение без стресса и ограничений</i>\n"
     "📆 <b>Старт: 17 ноября</b>\n"
@@ -302,13 +350,16 @@ async def handle_buy_course(callback: CallbackQuery):
     "• Доступ 6 месяцев\n\n"
     "🚀 <b>Оформить участие:</b>\n"
     "👉 <a href='https://www.nutrikaz.kz/#rec1462578793'>Перейти к оплате курса</a>"
-    )
+)
 
-    
+
+@common_router.callback_query(F.data == "buy_course", flags={"throttle": "buy"})
+async def handle_buy_course(callback: CallbackQuery):
+    """Единый оффер — покупка курса (доступен на всех этапах)"""
     await callback.message.answer(
-        text=course_info,
+        text=COURSE_INFO_TEXT,
         parse_mode="HTML",
-        reply_markup=ReplyKeyboards.back_to_menu()
+        reply_markup=BACK_TO_MENU_KB
     )
     await callback.answer("Переходим к покупке!")
 
@@ -317,7 +368,7 @@ async def handle_buy_course(callback: CallbackQuery):
 # ВОЗВРАТ В ГЛАВНОЕ МЕНЮ
 # =============================================================================
 
-@common_router.callback_query(F.data == "main_menu")
+@common_router.callback_query(F.data == "main_menu", flags={"throttle": "menu"})
 @common_router.message(F.text.contains("Главное меню"))
 async def back_to_main_menu(event, session: AsyncSession):
     """Возврат в главное меню — с актуальным этапом"""
@@ -328,29 +379,12 @@ async def back_to_main_menu(event, session: AsyncSession):
         method = event.answer if isinstance(event, Message) else event.message.answer
         await method(
             "Ошибка загрузки меню.",
-            reply_markup=ReplyKeyboards.back_to_menu()
+            reply_markup=BACK_TO_MENU_KB
         )
         return
 
-    caption = stage_text.main_menu_text
-    banner_path = Path("media/main_banner.jpg")
-    main_menu_inline = InlineKeyboards.main_menu(stage)
-
-    if banner_path.exists():
-        method = event.answer_photo if isinstance(event, Message) else event.message.answer_photo
-        await method(
-            photo=FSInputFile(banner_path),
-            caption=caption,
-            parse_mode="HTML",
-            reply_markup=main_menu_inline
-        )
-    else:
-        method = event.answer if isinstance(event, Message) else event.message.answer
-        await method(
-            caption,
-            parse_mode="HTML",
-            reply_markup=main_menu_inline
-        )
+    message = event if isinstance(event, Message) else event.message
+    await _answer_with_banner(message, stage_text.main_menu_text, MAIN_MENU_KB_BY_STAGE[stage])
     
     if isinstance(event, CallbackQuery):
         await event.answer("Вернулись в меню")
@@ -370,16 +404,14 @@ async def help_command(message: Message):
         "• Купить курс — оплатить\n\n"
         "Поддержка: @support_nutri",
         parse_mode="HTML",
-        reply_markup=ReplyKeyboards.back_to_menu()
+        reply_markup=BACK_TO_MENU_KB
     )
 
 
 @common_router.message()
-async def unknown_message(message: Message, session: AsyncSession):
-    """Любое неизвестное сообщение"""
-    stage = get_current_stage()
-    main_menu_inline = InlineKeyboards.main_menu(stage)
+async def unknown_message(message: Message):
+    """Любое неизвестное сообщение — без обращений к БД"""
     await message.answer(
         "Не понял команду.\nВыберите действие:",
-        reply_markup=main_menu_inline
+        reply_markup=MAIN_MENU_KB_BY_STAGE[get_current_stage()]
     )
\ No newline at end of file
@@ -10,8 +10,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database.models import User
 from app.database.crud_user import get_user_by_id
-from app.database.crud_admin import add_message_schedule, add_lead_magnet_stat
+from app.database.crud_admin import add_message_schedules_bulk
 from app.kbds.kbds import InlineKeyboards
+from app.utils.stat_batcher import stat_batcher
 
 from app.database.state import LeadMagnetState
 
@@ -22,10 +23,9 @@ lead_magnet_router = Router()
 # КОНФИГУРАЦИЯ — РЕАЛЬНЫЕ ДАТЫ (14–17 НОЯБРЯ)
 # =============================================================================
 ALMATY_TZ = ZoneInfo("Asia/Almaty")
-NOW = datetime.now(ALMATY_TZ)
 
-LESSON_START = NOW.replace(year=2025, month=11, day=14, hour=10, minute=0, second=0, microsecond=0)
-LESSON_END = NOW.replace(year=2025, month=11, day=17, hour=23, minute=59, second=0, microsecond=0)
+LESSON_START = datetime(2025, 11, 14, 10, 0, tzinfo=ALMATY_TZ)
+LESSON_END = datetime(2025, 11, 17, 23, 59, tzinfo=ALMATY_TZ)
 COURSE_START_DATE = "17 ноября"
 
 COURSE_LINK = "https://www.nutrikaz.kz/#rec1462578793"
@@ -86,47 +86,43 @@ LEAD_MAGNET_TEXTS = {
 # ПЛАНИРОВАНИЕ СООБЩЕНИЙ
 # =============================================================================
 async def schedule_lead_magnet_messages(session: AsyncSession, user: User, state: FSMContext):
-    try:
-        now = datetime.now(ALMATY_TZ)
-        lesson_time = now + timedelta(minutes=1)
-        reminder_time = now + timedelta(days=2)
-
-        reminders = [
-            (lesson_time, "welcome"),
-            (reminder_time, "reminder"),
-        ]
-
-        for scheduled_at, text_key in reminders:
-            if scheduled_at > now:
-                text = LEAD_MAGNET_TEXTS.get(text_key, f"[ОШИБКА: нет текста {text_key}]")
-                await add_message_schedule(
-                    session=session,
-                    user_id=user.id,
-                    message_text=text,
-                    scheduled_at=scheduled_at.replace(tzinfo=ALMATY_TZ)
-                )
-
-        await session.commit()
-        logger.info(f"Лид-магнит запланирован (этап 3): user {user.user_id} | урок: {lesson_time.strftime('%d.%m %H:%M')}")
-    except Exception as e:
-        await session.rollback()
-        logger.error(f"Ошибка планирования лид-магнита: {e}")
+    """Планирует урок и напоминание лид-магнита. Коммит и откат при ошибке — на вызывающей стороне."""
+    now = datetime.now(ALMATY_TZ)
+    lesson_time = now + timedelta(minutes=1)
+    reminder_time = now + timedelta(days=2)
+
+    reminders = [
+        (lesson_time, "welcome"),
+        (reminder_time, "reminder"),
+    ]
+
+    # Все напоминания — одним INSERT; send_time хранится naive по Алматы
+    rows = [
+        {
+            "user_id": user.id,
+            "message_text": LEAD_MAGNET_TEXTS.get(text_key) or f"[ОШИБКА: нет текста {text_key}]",
+            "send_time": scheduled_at.replace(tzinfo=None),
+            "sent": False,
+        }
+        for scheduled_at, text_key in reminders
+        if scheduled_at > now
+    ]
+    await add_message_schedules_bulk(session, rows, commit=False)
+
+    logger.info("Лид-магнит запланирован (этап 3): user %s | урок: %s", user.user_id, lesson_time.strftime('%d.%m %H:%M'))
 
 # =============================================================================
 # СТАТИСТИКА
 # =============================================================================
-async def _track_lead_magnet_stat(session: AsyncSession, user_id: int, stage: str, **kwargs):
-    try:
-        await add_lead_magnet_stat(
-            session=session,
-            user_id=user_id,
-            template_version="a",
-            stage=stage,
-            viewed=kwargs.get("viewed", False),
-            feedback_type=kwargs.get("feedback_type")
-        )
-    except Exception as e:
-        logger.error(f"Ошибка записи статистики: {e}")
+def _track_lead_magnet_stat(user_id: int, stage: str, **kwargs):
+    """Статистика пишется в БД пачками фоновым StatBatcher — хендлер INSERT не ждёт."""
+    stat_batcher.submit({
+        "user_id": user_id,
+        "template_version": "a",
+        "stage": stage,
+        "viewed": kwargs.get("viewed", False),
+        "feedback_type": kwargs.get("feedback_type"),
+    })
 
 # =============================================================================
 # ХЕНДЛЕРЫ
@@ -138,10 +134,17 @@ async def lead_magnet_registration(callback: CallbackQuery, session: AsyncSessio
         await callback.answer("Ошибка: пользователь не найден.")
         return
 
-    await _track_lead_magnet_stat(session, user.user_id, "welcome", viewed=False)
-    await session.commit()
+    try:
+        await schedule_lead_magnet_messages(session, user, state)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        logger.exception("Ошибка планирования лид-магнита: user %s", user.user_id)
+        await callback.answer("Ошибка. Попробуйте позже.", show_alert=True)
+        return
 
-    await schedule_lead_magnet_messages(session, user, state)
+    # Статистику пишем только для состоявшейся регистрации
+    _track_lead_magnet_stat(user.user_id, "welcome", viewed=False)
 
     await callback.message.answer(
         "🎬 Бесплатный урок активирован!\nОн придёт через несколько минут ⏰",
@@ -162,14 +165,13 @@ async def lead_feedback_start(callback: CallbackQuery, state: FSMContext):
 @lead_magnet_router.callback_query(LeadMagnetState.feedback, F.data.startswith("feedback_"))
 async def process_feedback(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
     try:
-        feedback_type = callback.data.split("_")[1]
+        feedback_type = callback.data.removeprefix("feedback_")
         user = await get_user_by_id(session, callback.from_user.id)
 
-        await _track_lead_magnet_stat(
-            session, user.user_id, "feedback",
+        _track_lead_magnet_stat(
+            user.user_id, "feedback",
             feedback_type=feedback_type, viewed=True
         )
-        await session.commit()
 
         await callback.message.answer(
             LEAD_MAGNET_TEXTS["feedback_thanks"],
@@ -10,7 +10,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database.models import User
 from app.database.crud_user import get_user_by_id
-from app.database.crud_admin import add_message_schedule, assign_user_to_lead_source
+from app.database.crud_admin import add_message_schedules_bulk, assign_user_to_lead_source
 from app.kbds.kbds import InlineKeyboards
 
 logger = logging.getLogger(__name__)
@@ -19,7 +19,8 @@ webinar_router = Router()
 # =============================================================================
 # ЭТАП 1 — ПЕРВЫЙ ВХОД (только вебинар)
 # =============================================================================
-WEBINAR_DATETIME = datetime(2025, 11, 6, 18, 30, tzinfo=ZoneInfo("Asia/Almaty"))
+ALMATY_TZ = ZoneInfo("Asia/Almaty")
+WEBINAR_DATETIME = datetime(2025, 11, 6, 18, 30, tzinfo=ALMATY_TZ)
 STREAM_LINK = "https://us06web.zoom.us/j/85077064347?pwd=5vFY3r8BVcYMsb8pLtEQJgPOFrLZwn.1"
 RECORD_LINK = "https://drive.google.com/drive/folders/1M6hjnEfcaZMjCWuSOX1SITAvzHjheY7p"
 COURSE_LINK = "https://www.nutrikaz.kz/#rec1462578793"
@@ -80,36 +81,31 @@ WEBINAR_TEXTS = {
 # ПЛАНИРОВАНИЕ НАПОМИНАНИЙ
 # =============================================================================
 async def schedule_webinar_reminders(session: AsyncSession, user: User, state: FSMContext):
-    """Планирует 3 сообщения: утром, за час, после вебинара."""
-    try:
-        now = datetime.now(ZoneInfo("Asia/Almaty"))
+    """Планирует 3 сообщения: утром, за час, после вебинара. Коммит и откат — на вызывающей стороне."""
+    now = datetime.now(ALMATY_TZ)
 
-        reminders = [
-            # Утром
-            (WEBINAR_DATETIME.replace(hour=10, minute=0, second=0, microsecond=0), "morning"),
-            # За 1 час
-            (WEBINAR_DATETIME - timedelta(hours=1), "hour_before"),
-            # После — полная дата 06.11.2025 20:50
-            (datetime(2025, 11, 6, 20, 56, tzinfo=ZoneInfo("Asia/Almaty")), "after"),
-        ]
+    reminders = [
+        # Утром
+        (WEBINAR_DATETIME.replace(hour=10, minute=0, second=0, microsecond=0), "morning"),
+        # За 1 час
+        (WEBINAR_DATETIME - timedelta(hours=1), "hour_before"),
+        # После — полная дата 06.11.2025 20:50
+        (datetime(2025, 11, 6, 20, 56, tzinfo=ALMATY_TZ), "after"),
+    ]
 
-        for scheduled_at, text_key in reminders:
-            if scheduled_at > now:
-                text = WEBINAR_TEXTS.get(text_key, f"[ОШИБКА: нет текста {text_key}]")
-                await add_message_schedule(
-                    session=session,
-                    user_id=user.id,
-                    message_text=text,
-                    scheduled_at=scheduled_at
-                )
+    rows = [
+        {
+            "user_id": user.id,
+            "message_text": WEBINAR_TEXTS.get(text_key) or f"[ОШИБКА: нет текста {text_key}]",
+            "send_time": scheduled_at.replace(tzinfo=None),
+            "sent": False,
+        }
+        for scheduled_at, text_key in reminders
+        if scheduled_at > now
+    ]
+    await add_message_schedules_bulk(session, rows, commit=False)
 
-        await session.commit()
-        logger.info(f"✅ Напоминания для вебинара запланированы: user {user.id}")
-
-    except Exception as e:
-        await session.rollback()
-        logger.error(f"❌ Ошибка планирования напоминаний: {e}")
-        raise
+    logger.info("✅ Напоминания для вебинара запланированы: user %s", user.id)
 
 # =============================================================================
 # РЕГИСТРАЦИЯ НА ВЕБИНАР
@@ -122,14 +118,19 @@ async def webinar_registration(callback: CallbackQuery, session: AsyncSession, s
         await callback.answer("Ошибка: пользователь не найден.")
         return
 
-    await assign_user_to_lead_source(session, user.user_id, "webinar")
-    await session.commit()
+    try:
+        await assign_user_to_lead_source(session, user.user_id, "webinar")
+        await schedule_webinar_reminders(session, user, state)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        logger.exception("❌ Ошибка регистрации на вебинар: user %s", user.user_id)
+        await callback.answer("Ошибка. Попробуйте позже.", show_alert=True)
+        return
 
     await callback.message.answer(
         WEBINAR_TEXTS["welcome_after_reg"],
         parse_mode="HTML",
         reply_markup=InlineKeyboards.post_webinar_keyboard(after_webinar=False)
     )
-
-    await schedule_webinar_reminders(session, user, state)
     await callback.answer("Вы зарегистрированы на вебинар!")
@@ -0,0 +1,19 @@
+from typing import Literal
+
+from aiogram.filters.callback_data import CallbackData
+
+
+# =============================================================================
+# CALLBACK DATA — ТИПИЗИРОВАННЫЕ КОЛБЭКИ АДМИНКИ
+# =============================================================================
+
+class LeadCb(CallbackData, prefix="lead"):
+    """Действие над источником лидов: фильтр пользователей, удаление, подтверждение."""
+    action: Literal["filter", "delete", "confirm"]
+    id: int
+
+
+class EditTextCb(CallbackData, prefix="edit_text"):
+    """Редактирование поля текста этапа (приветствие или текст меню)."""
+    field: Literal["welcome_text", "main_menu_text"]
+    stage: str
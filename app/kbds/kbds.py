@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import List, Optional
 from zoneinfo import ZoneInfo
 from aiogram.types import (
@@ -10,6 +11,7 @@ from aiogram.types import (
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 
 from app.database.models import LeadSource
+from app.kbds.callbacks import LeadCb
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.database.crud_admin import get_lead_sources
 
@@ -18,8 +20,49 @@ from app.database.crud_admin import get_lead_sources
 # INLINE KEYBOARD MARKUPS
 # =============================================================================
 
+# Статичные клавиатуры собираются один раз при импорте; методы классов возвращают готовые объекты
+
+_BUY_COURSE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💎 Купить курс", callback_data="buy_course")],
+    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
+])
+
+_ADMIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="📋 Источники лидов", callback_data="lead_source_menu"),
+        InlineKeyboardButton(text="📨 Сообщения", callback_data="message_menu")
+    ],
+    [
+        InlineKeyboardButton(text="📢 Рассылка", callback_data="broadcast_menu"),
+        InlineKeyboardButton(text="👥 Пользователи", callback_data="users_menu")
+    ],
+    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
+])
+
+_LEAD_MAGNET_LESSON_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💎 Купить полный курс", callback_data="buy_course")],
+    [InlineKeyboardButton(text="💬 Оставить отзыв", callback_data="lead_feedback")],
+    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
+])
+
+_LEAD_MAGNET_FEEDBACK_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="1️⃣ Дефицит", callback_data="feedback_1")],
+    [InlineKeyboardButton(text="2️⃣ Гормоны", callback_data="feedback_2")],
+    [InlineKeyboardButton(text="3️⃣ Психология", callback_data="feedback_3")],
+    [InlineKeyboardButton(text="💎 Купить курс", callback_data="buy_course")],
+    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
+])
+
+_CHALLENGE_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💬 Чат участников", url="https://t.me/nutrikaz")],
+    [InlineKeyboardButton(text="💎 Купить курс", callback_data="buy_course")],
+    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
+])
+
+
 class InlineKeyboards:
     @staticmethod
+    @lru_cache(maxsize=8)
     def main_menu(stage: str = "stage1") -> InlineKeyboardMarkup:
         """ГЛАВНОЕ МЕНЮ — кнопки по этапу"""
         buttons = []
@@ -39,44 +82,22 @@ class InlineKeyboards:
 
     @staticmethod
     def buy_course() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💎 Купить курс", callback_data="buy_course")],
-            [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
-        ])
+        return _BUY_COURSE_KB
 
     @staticmethod
     def admin_menu() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="📋 Источники лидов", callback_data="lead_source_menu"),
-                InlineKeyboardButton(text="📨 Сообщения", callback_data="message_menu")
-            ],
-            [
-                InlineKeyboardButton(text="📢 Рассылка", callback_data="broadcast_menu"),
-                InlineKeyboardButton(text="👥 Пользователи", callback_data="users_menu")
-            ],
-            [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
-        ])
+        return _ADMIN_MENU_KB
 
     @staticmethod
     def lead_magnet_lesson() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💎 Купить полный курс", callback_data="buy_course")],
-            [InlineKeyboardButton(text="💬 Оставить отзыв", callback_data="lead_feedback")],
-            [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
-        ])
+        return _LEAD_MAGNET_LESSON_KB
 
     @staticmethod
     def lead_magnet_feedback() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="1️⃣ Дефицит", callback_data="feedback_1")],
-            [InlineKeyboardButton(text="2️⃣ Гормоны", callback_data="feedback_2")],
-            [InlineKeyboardButton(text="3️⃣ Психология", callback_data="feedback_3")],
-            [InlineKeyboardButton(text="💎 Купить курс", callback_data="buy_course")],
-            [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
-        ])
+        return _LEAD_MAGNET_FEEDBACK_KB
 
     @staticmethod
+    @lru_cache(maxsize=8)
     def post_webinar_keyboard(after_webinar: bool = False, record_link: str = None) -> InlineKeyboardMarkup:
         """Клавиатура после регистрации / вебинара"""
         buttons = []
@@ -91,11 +112,7 @@ class InlineKeyboards:
 
     @staticmethod
     def challenge_menu() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💬 Чат участников", url="https://t.me/nutrikaz")],
-            [InlineKeyboardButton(text="💎 Купить курс", callback_data="buy_course")],
-            [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
-        ])
+        return _CHALLENGE_MENU_KB
 
 
 # =============================================================================
@@ -123,40 +140,50 @@ class ReplyKeyboards:
 
     @staticmethod
     def admin_main() -> ReplyKeyboardMarkup:
-        return ReplyKeyboards.get_keyboard(
-            "📋 Источники лидов",
-            "📨 Персональные сообщения",
-            "📢 Массовая рассылка",
-            "👥 Пользователи",
-            "🛠 Изменить тексты",
-            placeholder="Выберите раздел",
-            sizes=(2,)
-        )
+        return _ADMIN_MAIN_REPLY_KB
 
     @staticmethod
     def main_menu() -> ReplyKeyboardMarkup:
-        return ReplyKeyboards.get_keyboard(
-            "🎥 Вебинар",
-            "🎓 Бесплатный урок",
-            "🔥 Мини-челлендж",
-            "💎 Купить курс",
-            placeholder="Выберите действие",
-            sizes=(2,)
-        )
+        return _MAIN_MENU_REPLY_KB
 
     @staticmethod
     def back_to_menu() -> ReplyKeyboardMarkup:
-        return ReplyKeyboards.get_keyboard("🏠 Главное меню", placeholder="Вернуться", sizes=(1,))
+        return _BACK_TO_MENU_REPLY_KB
 
     @staticmethod
     def phone_request() -> ReplyKeyboardMarkup:
-        return ReplyKeyboards.get_keyboard(
-            "📱 Отправить телефон",
-            "❌ Отмена",
-            request_contact=0,
-            placeholder="Нажмите для отправки",
-            sizes=(1,)
-        )
+        return _PHONE_REQUEST_REPLY_KB
+
+
+# Статичные reply-клавиатуры собираются один раз при импорте
+_ADMIN_MAIN_REPLY_KB = ReplyKeyboards.get_keyboard(
+    "📋 Источники лидов",
+    "📨 Персональные сообщения",
+    "📢 Массовая рассылка",
+    "👥 Пользователи",
+    "🛠 Изменить тексты",
+    placeholder="Выберите раздел",
+    sizes=(2,)
+)
+
+_MAIN_MENU_REPLY_KB = ReplyKeyboards.get_keyboard(
+    "🎥 Вебинар",
+    "🎓 Бесплатный урок",
+    "🔥 Мини-челлендж",
+    "💎 Купить курс",
+    placeholder="Выберите действие",
+    sizes=(2,)
+)
+
+_BACK_TO_MENU_REPLY_KB = ReplyKeyboards.get_keyboard("🏠 Главное меню", placeholder="Вернуться", sizes=(1,))
+
+_PHONE_REQUEST_REPLY_KB = ReplyKeyboards.get_keyboard(
+    "📱 Отправить телефон",
+    "❌ Отмена",
+    request_contact=0,
+    placeholder="Нажмите для отправки",
+    sizes=(1,)
+)
 
 
 # =============================================================================
@@ -190,7 +217,7 @@ class DynamicKeyboards:
     def users_by_lead(leads: List[LeadSource]) -> InlineKeyboardMarkup:
         kb = []
         for lead in leads:
-            kb.append([InlineKeyboardButton(text=f"📋 {lead.name}", callback_data=f"filter_users_{lead.id}")])
+            kb.append([InlineKeyboardButton(text=f"📋 {lead.name}", callback_data=LeadCb(action="filter", id=lead.id).pack())])
         kb.append([InlineKeyboardButton(text="🔙 Назад", callback_data="users_menu")])
         return InlineKeyboardMarkup(inline_keyboard=kb)
 
@@ -199,62 +226,75 @@ class DynamicKeyboards:
 # АДМИН КЛАВИАТУРЫ — С ЭМОДЗИ
 # =============================================================================
 
+_LEAD_SOURCE_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="➕ Создать источник", callback_data="create_lead_source")],
+    [InlineKeyboardButton(text="📋 Посмотреть все", callback_data="view_leads")],
+    [InlineKeyboardButton(text="🗑 Удалить источник", callback_data="delete_lead_menu")],
+    [InlineKeyboardButton(text="🔙 В меню", callback_data="admin_main")]
+])
+
+_MESSAGE_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📨 Отправить сообщение", callback_data="send_message")],
+    [InlineKeyboardButton(text="🔙 В меню", callback_data="admin_main")]
+])
+
+_BROADCAST_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📢 Создать рассылку", callback_data="create_broadcast")],
+    [InlineKeyboardButton(text="🔙 В меню", callback_data="admin_main")]
+])
+
+_USERS_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="👥 Все пользователи", callback_data="users_all")],
+    [InlineKeyboardButton(text="📋 По источнику лидов", callback_data="users_by_lead")],
+    [InlineKeyboardButton(text="🔙 В меню", callback_data="admin_main")]
+])
+
+_BROADCAST_TYPE_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="📝 Текст", callback_data="broadcast_text"),
+        InlineKeyboardButton(text="🖼️ Картинка", callback_data="broadcast_image")
+    ],
+    [
+        InlineKeyboardButton(text="📎 Файл", callback_data="broadcast_file"),
+        InlineKeyboardButton(text="🎥 Видео", callback_data="broadcast_video")
+    ],
+    [InlineKeyboardButton(text="🔙 Назад", callback_data="create_broadcast")]
+])
+
+_PERSONAL_MESSAGE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="📝 Текст", callback_data="message_text"),
+        InlineKeyboardButton(text="🖼️ Картинка", callback_data="message_image")
+    ],
+    [
+        InlineKeyboardButton(text="📎 Файл", callback_data="message_file"),
+        InlineKeyboardButton(text="🎥 Видео", callback_data="message_video")
+    ],
+    [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_main")]
+])
+
+
 class AdminKeyboards:
     @staticmethod
     def lead_source_menu() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="➕ Создать источник", callback_data="create_lead_source")],
-            [InlineKeyboardButton(text="📋 Посмотреть все", callback_data="view_leads")],
-            [InlineKeyboardButton(text="🗑 Удалить источник", callback_data="delete_lead_menu")],
-            [InlineKeyboardButton(text="🔙 В меню", callback_data="admin_main")]
-        ])
+        return _LEAD_SOURCE_MENU_KB
 
     @staticmethod
     def message_menu() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📨 Отправить сообщение", callback_data="send_message")],
-            [InlineKeyboardButton(text="🔙 В меню", callback_data="admin_main")]
-        ])
+        return _MESSAGE_MENU_KB
 
     @staticmethod
     def broadcast_menu() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📢 Создать рассылку", callback_data="create_broadcast")],
-            [InlineKeyboardButton(text="🔙 В меню", callback_data="admin_main")]
-        ])
+        return _BROADCAST_MENU_KB
 
     @staticmethod
     def users_menu() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="👥 Все пользователи", callback_data="users_all")],
-            [InlineKeyboardButton(text="📋 По источнику лидов", callback_data="users_by_lead")],
-            [InlineKeyboardButton(text="🔙 В меню", callback_data="admin_main")]
-        ])
+        return _USERS_MENU_KB
 
     @staticmethod
     def broadcast_type_menu() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="📝 Текст", callback_data="broadcast_text"),
-                InlineKeyboardButton(text="🖼️ Картинка", callback_data="broadcast_image")
-            ],
-            [
-                InlineKeyboardButton(text="📎 Файл", callback_data="broadcast_file"),
-                InlineKeyboardButton(text="🎥 Видео", callback_data="broadcast_video")
-            ],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="create_broadcast")]
-        ])
+        return _BROADCAST_TYPE_MENU_KB
 
     @staticmethod
     def personal_message() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="📝 Текст", callback_data="message_text"),
-                InlineKeyboardButton(text="🖼️ Картинка", callback_data="message_image")
-            ],
-            [
-                InlineKeyboardButton(text="📎 Файл", callback_data="message_file"),
-                InlineKeyboardButton(text="🎥 Видео", callback_data="message_video")
-            ],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_main")]
-        ])
+        return _PERSONAL_MESSAGE_KB
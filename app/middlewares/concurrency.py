@@ -0,0 +1,25 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """
+    Ограничивает число одновременно выполняемых хендлеров (общий лимит limit
+    на все события, где зарегистрирован экземпляр). Лишние апдейты ждут своей
+    очереди, а не набрасываются на пул соединений БД при всплеске нажатий.
+    """
+
+    def __init__(self, limit: int):
+        self.sem = asyncio.Semaphore(limit)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with self.sem:
+            return await handler(event, data)
@@ -0,0 +1,38 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, TelegramObject
+
+from app.utils.cache import TTLCache
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Отбрасывает повторные нажатия пользователем в течение rate секунд — только для
+    хендлеров с флагом throttle, остальные апдейты проходят без ограничений.
+    Ключ — (user_id, значение флага): хендлеры с одинаковым флагом делят общий лимит.
+    Повтор гасится локально, без отправки сообщений.
+    """
+
+    def __init__(self, rate: float = 2, maxsize: int = 100_000):
+        self.rate = rate
+        self.cache = TTLCache(ttl=rate, maxsize=maxsize)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        throttle = get_flag(data, "throttle")
+        if throttle is None or not isinstance(event, CallbackQuery):
+            return await handler(event, data)
+
+        key = (event.from_user.id, throttle)
+        if self.cache.get(key):
+            await event.answer("⏳", cache_time=int(self.rate))
+            return None
+
+        self.cache.set(key, True)
+        return await handler(event, data)
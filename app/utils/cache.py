@@ -0,0 +1,85 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Простой in-process кэш с временем жизни записей.
+    Подходит для редко меняющихся данных (источники лидов, тексты этапов).
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: dict[Hashable, tuple[float, Any]] = {}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Возвращает значение или default, если записи нет или она устарела."""
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self._data.pop(key, None)
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Кладёт значение в кэш; при переполнении вытесняет самые старые записи."""
+        if key not in self._data and len(self._data) >= self.maxsize:
+            self._evict()
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _) in self._data.items() if expires_at < now]:
+            del self._data[key]
+        while len(self._data) >= self.maxsize:
+            del self._data[next(iter(self._data))]
+
+
+async def cached(cache: TTLCache, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Читает значение из кэша, при промахе вызывает fetch() и запоминает результат.
+    None не кэшируется — отсутствующие записи каждый раз перепроверяются в БД.
+    """
+    value = cache.get(key)
+    if value is None:
+        value = await fetch()
+        if value is not None:
+            cache.set(key, value)
+    return value
+
+
+_in_flight: dict[Hashable, asyncio.Future] = {}
+
+
+async def single_flight(key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+    """
+    Склеивает одновременные одинаковые запросы: пока первый вызов с ключом key
+    выполняется, остальные ждут его результат вместо повторного fetch().
+    Возвращает (значение, shared): shared=True у тех, кто получил чужой результат.
+
+    fetch() должен сам открывать сессию и возвращать данные, не привязанные к ней:
+    задача выполняется под shield и доживает до конца, даже если первый вызов отменён.
+    """
+    fut = _in_flight.get(key)
+    if fut is not None:
+        return await asyncio.shield(fut), True
+
+    fut = asyncio.ensure_future(fetch())
+    _in_flight[key] = fut
+
+    def _release(done: asyncio.Future) -> None:
+        if _in_flight.get(key) is done:
+            del _in_flight[key]
+
+    fut.add_done_callback(_release)
+    return await asyncio.shield(fut), False
@@ -1,17 +1,28 @@
-from typing import Any, List
+from collections.abc import Iterable, Sequence
+from typing import Any, Optional
 import re
 
+from sqlalchemy import Select, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# \Z вместо $: «$» пропускает завершающий перевод строки
+_LEAD_NAME_RE = re.compile(r"[a-zA-Zа-яА-ЯёЁ0-9_-]+\Z")
+
+
 def validate_lead_name(name: str) -> bool:
     """Валидация названия источника лидов с поддержкой кириллицы."""
-    return 3 <= len(name) <= 50 and bool(re.match(r"^[a-zA-Zа-яА-ЯёЁ0-9_-]+$", name))
+    return 3 <= len(name) <= 50 and _LEAD_NAME_RE.match(name) is not None
 
 
 
-def paginate(items: List[Any], page: int, per_page: int = 5) -> dict:
+def paginate(items: Iterable[Any], page: int, per_page: int = 5) -> dict:
     """
-    Простая пагинация.
+    Простая пагинация небольших списков в памяти.
     Возвращает: {'items': [...], 'page': 1, 'pages': 3, 'has_next': True}
+    Для выборок из БД — paginate_query (LIMIT/OFFSET на стороне базы).
     """
+    if not isinstance(items, Sequence):
+        items = list(items)
     total_pages = (len(items) + per_page - 1) // per_page
     start = (page - 1) * per_page
     end = start + per_page
@@ -22,4 +33,24 @@ def paginate(items: List[Any], page: int, per_page: int = 5) -> dict:
         'pages': total_pages,
         'has_next': page < total_pages,
         'has_prev': page > 1
-    }
\ No newline at end of file
+    }
+
+
+async def paginate_query(
+    session: AsyncSession,
+    stmt: Select,
+    page: int,
+    per_page: int = 5,
+    total: Optional[int] = None
+) -> tuple[list[Any], int]:
+    """
+    Страница запроса через LIMIT/OFFSET и общее число строк.
+    total можно передать готовым (например, из кэша) — тогда COUNT(*) не выполняется.
+    """
+    result = await session.execute(stmt.limit(per_page).offset((page - 1) * per_page))
+    items = result.all()
+    if total is None:
+        total = await session.scalar(
+            select(func.count()).select_from(stmt.order_by(None).subquery())
+        )
+    return items, total
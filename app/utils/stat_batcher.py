@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import time
+from typing import Any, Optional
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.database.crud_admin import add_lead_magnet_stats_bulk
+
+logger = logging.getLogger(__name__)
+
+
+class StatBatcher:
+    """
+    Копит записи статистики лид-магнита в памяти и пишет их в БД пачками:
+    до max_batch строк или раз в max_delay секунд — что наступит раньше.
+    Хендлеры не ждут INSERT, а только кладут строку в очередь.
+    Очередь ограничена max_queue: если БД недоступна, лишние строки
+    отбрасываются, а не копятся в памяти.
+    """
+
+    def __init__(self, max_batch: int = 100, max_delay: float = 0.5, max_queue: int = 10_000):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue: asyncio.Queue[dict[str, Any]] = asyncio.Queue(maxsize=max_queue)
+        self._session_maker: Optional[async_sessionmaker] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, row: dict[str, Any]) -> None:
+        """Ставит строку статистики в очередь на запись; никогда не блокирует хендлер."""
+        try:
+            self.queue.put_nowait(row)
+        except asyncio.QueueFull:
+            logger.warning("Очередь статистики переполнена, запись отброшена: %s", row)
+
+    def start(self, session_maker: async_sessionmaker) -> None:
+        """Запускает фоновый цикл записи; ссылка на задачу хранится, чтобы её не снял сборщик мусора."""
+        self._task = asyncio.create_task(self.run(session_maker))
+
+    async def stop(self) -> None:
+        """Останавливает цикл (он дописывает свою текущую пачку) и сбрасывает остаток очереди."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def run(self, session_maker: async_sessionmaker) -> None:
+        """Фоновый цикл записи; при отмене дописывает пачку, уже снятую с очереди, но ещё не записанную."""
+        self._session_maker = session_maker
+        batch: list[dict[str, Any]] = []
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.max_batch:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # Пачку передаём на запись до await: если отмена придёт во время
+                # записи, finally не запишет те же строки второй раз
+                pending, batch = batch, []
+                await self._write(pending)
+        finally:
+            await self._write(batch)
+
+    async def flush(self) -> None:
+        """Дописывает всё, что осталось в очереди (при остановке бота, после stop цикла)."""
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        await self._write(batch)
+
+    async def _write(self, batch: list[dict[str, Any]]) -> None:
+        if not batch or self._session_maker is None:
+            return
+        try:
+            async with self._session_maker() as session:
+                await add_lead_magnet_stats_bulk(session, batch)
+        except Exception:
+            logger.exception("Ошибка записи статистики лид-магнита (%s строк)", len(batch))
+
+
+stat_batcher = StatBatcher()
@@ -1,24 +1,24 @@
 import asyncio
 import os
-from datetime import datetime, timedelta
 import logging
-from zoneinfo import ZoneInfo
 
 from aiogram import Bot, Dispatcher, F
 from dotenv import load_dotenv, find_dotenv
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import Message
 
+from app.middlewares.concurrency import ConcurrencyLimitMiddleware
 from app.middlewares.db import DataBaseSession
-from app.database.models import async_session_maker, engine, Base, User, LeadSource
-from app.database.crud_admin import send_scheduled_broadcasts
+from app.database.models import DB_MAX_HANDLERS, async_session_maker, engine, Base, User, LeadSource
+from app.database.crud_admin import SCHEDULE_CHANNEL, get_next_due_delay, send_scheduled_broadcasts
 from sqlalchemy import select
 
 from app.handlers.common import common_router
 from app.handlers.admin import admin_router
 from app.handlers.webinar import webinar_router
-from app.handlers.challenge import challenge_router, register_challenge  
+from app.handlers.challenge import SCHEDULE_CHUNK_SIZE, challenge_router, schedule_challenge_for_users
 from app.handlers.lead_magnet import lead_magnet_router
+from app.utils.stat_batcher import stat_batcher
 
 from app.utils.filters import get_my_user_id
 
@@ -27,11 +27,22 @@ logger = logging.getLogger(__name__)
 
 load_dotenv(find_dotenv())
 
+# Ссылки на фоновые задачи держим, чтобы сборщик мусора не снял их до завершения
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 # === ОЖИДАНИЕ БД ===
 async def wait_for_db():
     import asyncpg
     db_url = os.getenv("SQLALCHEMY_URL").replace("+asyncpg", "")
     max_attempts = 30
+    delay = 0.5
     for i in range(max_attempts):
         try:
             conn = await asyncpg.connect(db_url)
@@ -39,67 +50,124 @@ async def wait_for_db():
             logger.info("БД доступна!")
             return
         except Exception as e:
-            logger.warning(f"Ожидание БД... ({i+1}/{max_attempts}) | Ошибка: {e}")
-            await asyncio.sleep(2)
+            logger.warning("Ожидание БД... (%s/%s) | Ошибка: %s", i+1, max_attempts, e)
+            await asyncio.sleep(delay)
+            # Экспоненциальная пауза: 0.5, 1, 2, 4, 4, ... — быстро ловим поднявшуюся БД
+            delay = min(delay * 2, 4)
     raise Exception("БД не стала доступной")
 
 async def create_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
-    logger.info("База данных инициализирована")
+        # create_all не трогает уже существующие таблицы — индексы докатываем отдельно
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                await conn.run_sync(index.create, checkfirst=True)
+    logger.info("База данных инициализирована | пул: %s", engine.pool.status())
 
 # === ВОССТАНОВЛЕНИЕ ЧЕЛЛЕНДЖА ДЛЯ ВСЕХ С lead_source = challenge ===
+# Сколько кусков участников восстанавливаем одновременно (каждый — в своей сессии)
+RESTORE_CONCURRENCY = 20
+
 async def restore_challenge_for_current_users():
     await asyncio.sleep(10)  
     try:
         async with async_session_maker() as session:
             result = await session.execute(
-                select(User).join(LeadSource).where(LeadSource.name == "challenge")
+                select(User.id).join(LeadSource).where(LeadSource.name == "challenge")
             )
-            users = result.scalars().all()
+            user_ids = result.scalars().all()
+
+        if not user_ids:
+            logger.info("Участников челленджа не найдено (lead_source=challenge)")
+            return
 
-            if not users:
-                logger.info("Участников челленджа не найдено (lead_source=challenge)")
-                return
+        logger.info("Начинаем восстановление челленджа для %s участников...", len(user_ids))
+        sem = asyncio.Semaphore(RESTORE_CONCURRENCY)
 
-            logger.info(f"Начинаем восстановление челленджа для {len(users)} участников...")
-            restored = 0
-            for user in users:
-                await register_challenge(session, user)
-                restored += 1
-                if restored % 5 == 0:
-                    logger.info(f"Восстановлено: {restored}/{len(users)}...")
+        async def restore_chunk(chunk: list[int]) -> int:
+            # Отдельная короткая транзакция на кусок: запросы кусков идут параллельно
+            async with sem, async_session_maker() as session:
+                added = await schedule_challenge_for_users(session, chunk)
+                await session.commit()
+                return added
 
-            await session.commit()
-            logger.info(f"ГОТОВО! Челлендж восстановлен для {len(users)} участников. "
-                        f"Завтра в 10:00 все получат сообщение!")
+        added = sum(await asyncio.gather(*(
+            restore_chunk(user_ids[i:i + SCHEDULE_CHUNK_SIZE])
+            for i in range(0, len(user_ids), SCHEDULE_CHUNK_SIZE)
+        )))
+        logger.info("ГОТОВО! Челлендж восстановлен для %s участников (новых сообщений: %s). "
+                    "Завтра в 10:00 все получат сообщение!", len(user_ids), added)
 
     except Exception as e:
-        logger.error(f"Ошибка восстановления челленджа: {e}", exc_info=True)
+        logger.error("Ошибка восстановления челленджа: %s", e, exc_info=True)
 
 # === ПЛАНИРОВЩИК (Алматы +05) ===
-async def scheduled_broadcast():
+# Дольше не спим даже при пустой очереди — страховка на случай потерянного NOTIFY
+SCHEDULER_MAX_IDLE = 300
+
+
+async def listen_schedule_changes(wakeup: asyncio.Event):
+    """Держит отдельное соединение с LISTEN: новая задача в БД будит планировщик сразу."""
+    import asyncpg
+    db_url = os.getenv("SQLALCHEMY_URL").replace("+asyncpg", "")
     while True:
+        conn = None
         try:
-            now = datetime.now(ZoneInfo("Asia/Almaty"))
-            next_check = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
-            sleep_time = (next_check - now).total_seconds()
-            logger.info(f"Следующая проверка рассылок: {next_check.strftime('%H:%M:%S')} (Алматы +05)")
-            await asyncio.sleep(sleep_time)
+            conn = await asyncpg.connect(db_url)
+            await conn.add_listener(SCHEDULE_CHANNEL, lambda *_: wakeup.set())
+            logger.info("Планировщик слушает канал %s", SCHEDULE_CHANNEL)
+            while True:
+                # Проверка соединения: при разрыве — исключение и переподключение
+                await asyncio.sleep(60)
+                await conn.execute("SELECT 1")
+        except Exception as e:
+            logger.warning("LISTEN %s прерван: %s — переподключение", SCHEDULE_CHANNEL, e)
+            wakeup.set()
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(5)
 
-            async with async_session_maker() as session:
-                await send_scheduled_broadcasts(session, bot)
+
+async def scheduled_broadcast():
+    wakeup = asyncio.Event()
+    _spawn(listen_schedule_changes(wakeup))
+    while True:
+        try:
+            # Сбрасываем до отправки: NOTIFY, пришедший во время тика, не потеряется
+            wakeup.clear()
+            await send_scheduled_broadcasts(async_session_maker, bot)
+
+            delay = await get_next_due_delay(async_session_maker)
+            if delay is None:
+                sleep_time = SCHEDULER_MAX_IDLE
+            else:
+                sleep_time = min(SCHEDULER_MAX_IDLE, max(1, delay))
+            logger.info("Следующая проверка рассылок через %.0f с (или по NOTIFY)", sleep_time)
+
+            try:
+                await asyncio.wait_for(wakeup.wait(), sleep_time)
+            except asyncio.TimeoutError:
+                pass
 
         except Exception as e:
-            logger.error(f"Ошибка в планировщике: {e}", exc_info=True)
+            logger.error("Ошибка в планировщике: %s", e, exc_info=True)
             await asyncio.sleep(60)
 
 async def main():
     global bot  
+    # Проверяем БД параллельно со сборкой бота и диспетчера
+    db_ready = asyncio.create_task(wait_for_db())
+
     bot = Bot(token=os.getenv("BOT_TOKEN"), default=DefaultBotProperties(parse_mode="HTML"))
     dp = Dispatcher()
 
     # Middleware
+    # Общий лимит одновременных хендлеров по ёмкости пула БД — до открытия сессии
+    concurrency_limit = ConcurrencyLimitMiddleware(limit=DB_MAX_HANDLERS)
+    dp.message.middleware(concurrency_limit)
+    dp.callback_query.middleware(concurrency_limit)
     dp.message.middleware(DataBaseSession(async_session_maker))
     dp.callback_query.middleware(DataBaseSession(async_session_maker))
 
@@ -114,15 +182,19 @@ async def main():
     async def my_id_handler(message: Message):
         await get_my_user_id(message)
 
-    await wait_for_db()
+    await db_ready
     dp.startup.register(create_db)
     
-    asyncio.create_task(scheduled_broadcast())
+    _spawn(scheduled_broadcast())
+    stat_batcher.start(async_session_maker)
 
-    asyncio.create_task(restore_challenge_for_current_users())
+    _spawn(restore_challenge_for_current_users())
 
     await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await stat_batcher.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file